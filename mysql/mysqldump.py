@@ -3,11 +3,28 @@
 # Tobias Kiertscher <dev@mastersign.de>
 
 import pymysql
+import pymysql.cursors
+from pymysql.converters import escape_item
+import os
 from os import path
 from numbers import Number
 import datetime
 import locale
 import argparse
+import json
+import glob
+import hashlib
+import zlib
+import bz2
+import lzma
+import struct
+import sys
+import itertools
+from array import array
+import threading
+import queue
+import shutil
+import time
 from getpass import getpass
 
 parser = argparse.ArgumentParser(
@@ -35,18 +52,90 @@ parser.add_argument(
     '-t', '--target',
     default=path.join(path.dirname(__file__), "data"),
     help='The target directory, to store the result files.')
+parser.add_argument(
+    '-b', '--batch-size',
+    default=1000,
+    type=int,
+    help='The number of rows to fetch from the server at once.')
+parser.add_argument(
+    '-j', '--jobs',
+    default=1,
+    type=int,
+    help='The number of tables to dump concurrently, ' +
+         'each over its own connection.')
+parser.add_argument(
+    '-msb', '--max-statement-bytes',
+    default=1024 * 1024,
+    type=int,
+    help='The maximum size of one multi-row INSERT statement in bytes. ' +
+         'It is capped by the max_allowed_packet of the server.')
+parser.add_argument(
+    '-cr', '--chunk-rows',
+    default=1000000,
+    type=int,
+    help='The estimated number of rows in one chunk of a large table. ' +
+         'Tables with an integer primary key are split into ' +
+         'primary key ranges of this size.')
+parser.add_argument(
+    '--resume',
+    action='store_true',
+    help='Continues the last interrupted dump in the target directory ' +
+         'from its checkpoint, without dumping finished chunks again.')
+parser.add_argument(
+    '-c', '--compress',
+    choices=['gzip', 'bz2', 'xz'],
+    help='Compresses the SQL and CSV files with the given method.')
+parser.add_argument(
+    '-cl', '--compress-level',
+    type=int,
+    help='The compression level, 1 (fast) to 9 (small). ' +
+         'The default depends on the compression method.')
+parser.add_argument(
+    '-f', '--format',
+    default='csv',
+    choices=['csv', 'columnar'],
+    help='The format of the table files beside the SQL file: ' +
+         'CSV or typed, column-oriented binary files, which are ' +
+         'never compressed, so they can be memory-mapped.')
+parser.add_argument(
+    '-rg', '--row-group-rows',
+    default=65536,
+    type=int,
+    help='The number of rows in one row group of a columnar file.')
+parser.add_argument(
+    '-i', '--incremental',
+    action='store_true',
+    help='Dumps only the tables, which changed since the last dump ' +
+         'in the target directory, and takes the unchanged tables ' +
+         'from the files of the last dump.')
+parser.add_argument(
+    '-fp', '--fingerprint',
+    default='checksum',
+    choices=['checksum', 'update_time'],
+    help='The way to detect changed tables in an incremental dump: ' +
+         'CHECKSUM TABLE or the UPDATE_TIME and size of the table.')
 args = parser.parse_args()
 
 db_host = args.server
+db_port = args.port
 db_user = args.user
 db_passwd = args.password
 db_name = args.database
 target = args.target
+batch_size = args.batch_size
+jobs = max(1, args.jobs)
+max_statement_bytes = args.max_statement_bytes
+chunk_rows = max(1, args.chunk_rows)
+compress = args.compress
+compress_level = args.compress_level
+data_format = args.format
+row_group_rows = max(1, args.row_group_rows)
 if not db_passwd:
     db_passwd = getpass('Password: ')
 
 if not db_name:
-    con = pymysql.connect(host=db_host, user=db_user, passwd=db_passwd)
+    con = pymysql.connect(host=db_host, port=db_port,
+                          user=db_user, passwd=db_passwd)
     cur = con.cursor()
     cur.execute("SHOW SCHEMAS;")
     print("Available schemas:")
@@ -58,60 +147,1157 @@ if not db_name:
 
 timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M")
 
-con = pymysql.connect(host=db_host, user=db_user, passwd=db_passwd, db=db_name)
-cur = con.cursor()
+
+def connect():
+    return pymysql.connect(host=db_host, port=db_port,
+                           user=db_user, passwd=db_passwd, db=db_name,
+                           charset='utf8mb4')
+
 
 sep = ','
 
 def format_value(v):
     global sep
+    if v is None:
+        # an unquoted NULL is read back as NULL by LOAD DATA
+        return 'NULL'
     if isinstance(v, Number):
         return str(v)
     else:
         v = str(v)
-        if sep in v or ' ' in v or '\t' in v:
+        if sep in v or ' ' in v or '\t' in v or '"' in v or \
+                '\n' in v or '\r' in v or v == 'NULL':
             return '"' + v.replace('"', '""') + '"'
         else:
             return v
 
-cur.execute("SHOW TABLES")
-data = ""
-tables = []
-for table in cur.fetchall():
-    tables.append(table[0])
 
-for table in tables:
-    table_csv = ""
-    data += "DROP TABLE IF EXISTS `" + str(table) + "`;"
+def format_number(v):
+    return 'NULL' if v is None else str(v)
+
+
+def format_time(v):
+    # pymysql returns TIME as timedelta, which str() writes as days,
+    # e.g. 1 day, 6:00:00 for 30:00:00
+    if not isinstance(v, datetime.timedelta):
+        return format_value(v)
+    total = (v.days * 86400 + v.seconds) * 1000000 + v.microseconds
+    sign = '-' if total < 0 else ''
+    (seconds, microseconds) = divmod(abs(total), 1000000)
+    text = '{0}{1:02d}:{2:02d}:{3:02d}'.format(
+        sign, seconds // 3600, seconds // 60 % 60, seconds % 60)
+    if microseconds:
+        text += '.{0:06d}'.format(microseconds)
+    return text
+
+
+def format_binary(v):
+    # binary values are written as hex digits,
+    # mysqlrestore loads them with UNHEX()
+    return 'NULL' if v is None else v.hex()
+
+
+def sql_literal(v):
+    if v is None:
+        return 'NULL'
+    if isinstance(v, (bytes, bytearray)):
+        # hex literals survive any client character set
+        return '0x' + v.hex() if v else "''"
+    return escape_item(v, 'utf8mb4')
+
+
+def sql_number(v):
+    return 'NULL' if v is None else str(v)
+
+
+def sql_binary(v):
+    if v is None:
+        return 'NULL'
+    return '0x' + v.hex() if v else "''"
+
+
+class InsertWriter(object):
+    """Groups rows into multi-row INSERT statements below a byte budget."""
+
+    def __init__(this, fh, table_info, max_bytes):
+        this.fh = fh
+        this.literals = [column.sql_literal for column in table_info.columns]
+        this.prefix = "INSERT INTO `" + str(table_info.name) + "` (" + \
+            ",".join(["`" + c.name + "`" for c in table_info.columns]) + \
+            ") VALUES\n"
+        this.prefix_size = len(this.prefix.encode('utf-8'))
+        this.max_bytes = max_bytes
+        this.size = 0
+
+    def add_rows(this, rows):
+        parts = []
+        literals = this.literals
+        for row in rows:
+            values = "(" + ",".join(
+                [literals[i](v) for (i, v) in enumerate(row)]) + ")"
+            size = len(values) if values.isascii() else len(values.encode('utf-8'))
+            if this.size and this.size + size + 2 > this.max_bytes:
+                parts.append(";\n")
+                this.size = 0
+            if this.size:
+                parts.append(",\n")
+                this.size += 2
+            else:
+                parts.append(this.prefix)
+                this.size = this.prefix_size
+            parts.append(values)
+            this.size += size
+        this.fh.write("".join(parts))
+
+    def close(this):
+        if this.size:
+            this.fh.write(";\n")
+            this.size = 0
+
+
+compress_extensions = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz'}
+
+
+def create_compressor():
+    if compress == 'gzip':
+        level = compress_level if compress_level is not None else 6
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compress == 'bz2':
+        level = compress_level if compress_level is not None else 9
+        return bz2.BZ2Compressor(level)
+    if compress == 'xz':
+        level = compress_level if compress_level is not None else 6
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=level)
+    return None
+
+
+def encode_member(text):
+    """Encodes a piece of text as a complete compressed member.
+
+    gzip, bzip2 and xz streams can be concatenated,
+    so members and part files can simply be appended to each other.
+    """
+    data = text.encode('utf-8')
+    compressor = create_compressor()
+    if compressor:
+        return compressor.compress(data) + compressor.flush()
+    return data
+
+
+def output_name(name):
+    return name + compress_extensions.get(compress, '')
+
+
+class OutputFile(object):
+    """A binary file for text, which is compressed in a background thread.
+
+    The writing thread only encodes the text and hands blocks over
+    through a bounded queue, so fetching rows from the server and
+    compressing them overlap, while the memory stays limited.
+    zlib, bz2 and lzma release the GIL while compressing.
+    """
+
+    block_size = 1024 * 1024
+
+    def __init__(this, filename):
+        this.fh = open(filename, "wb")
+        this.compressor = create_compressor()
+        this.buffer = []
+        this.buffered = 0
+        this.raw_bytes = 0
+        this.written_bytes = 0
+        this.error = None
+        if this.compressor:
+            this.blocks = queue.Queue(maxsize=4)
+            this.thread = threading.Thread(target=this.compress_blocks)
+            this.thread.daemon = True
+            this.thread.start()
+
+    def write(this, text):
+        data = text.encode('utf-8')
+        this.buffer.append(data)
+        this.buffered += len(data)
+        if this.buffered >= this.block_size:
+            this.flush_buffer()
+
+    def flush_buffer(this):
+        if not this.buffer:
+            return
+        block = b"".join(this.buffer)
+        this.buffer = []
+        this.buffered = 0
+        this.raw_bytes += len(block)
+        if this.compressor:
+            if this.error:
+                raise this.error
+            this.blocks.put(block)
+        else:
+            this.fh.write(block)
+
+    def compress_blocks(this):
+        try:
+            block = this.blocks.get()
+            while block is not None:
+                this.fh.write(this.compressor.compress(block))
+                block = this.blocks.get()
+            this.fh.write(this.compressor.flush())
+        except Exception as e:
+            this.error = e
+            # keep taking blocks, so the writing thread never blocks
+            while this.blocks.get() is not None:
+                pass
+
+    def close(this):
+        this.flush_buffer()
+        if this.compressor:
+            this.blocks.put(None)
+            this.thread.join()
+        this.written_bytes = this.fh.tell()
+        this.fh.close()
+        if this.error:
+            raise this.error
+
+
+class CsvWriter(object):
+    """Writes rows as CSV lines with a formatter per column."""
+
+    def __init__(this, filename, table_info, header=False):
+        this.fh = OutputFile(filename)
+        this.formatters = [column.csv_format for column in table_info.columns]
+        if header:
+            this.fh.write(csv_header(table_info))
+
+    def add_rows(this, rows):
+        formatters = this.formatters
+        this.fh.write("".join([
+            sep.join([formatters[i](v) for (i, v) in enumerate(row)]) + "\n"
+            for row in rows]))
+
+    def close(this):
+        this.fh.close()
+        this.raw_bytes = this.fh.raw_bytes
+        this.written_bytes = this.fh.written_bytes
+
+
+columnar_magic = b'MYCOL1\0\0'
+
+# the typecodes of the fixed width columnar types,
+# all other types are stored as offsets and data
+columnar_typecodes = {
+    'int64': 'q', 'uint64': 'Q', 'float64': 'd',
+    'date': 'q', 'timestamp': 'q', 'time': 'q'}
+
+epoch = datetime.datetime(1970, 1, 1)
+one_microsecond = datetime.timedelta(microseconds=1)
+
+
+def columnar_number(v):
+    return v
+
+
+def columnar_date(v):
+    # invalid dates like 0000-00-00 come as strings and are stored as NULL
+    if isinstance(v, datetime.date):
+        return (v - epoch.date()).days
+    return None
+
+
+def columnar_timestamp(v):
+    if isinstance(v, datetime.datetime):
+        return (v - epoch) // one_microsecond
+    return None
+
+
+def columnar_time(v):
+    if isinstance(v, datetime.timedelta):
+        return v // one_microsecond
+    return None
+
+
+def columnar_string(v):
+    return None if v is None else str(v).encode('utf-8')
+
+
+def columnar_binary(v):
+    return None if v is None else bytes(v)
+
+
+class ColumnarWriter(object):
+    """Writes rows as typed, column-oriented row groups.
+
+    Every column of a row group is stored as a null bitmap
+    and either a little-endian array of fixed width values
+    or an array of n + 1 offsets followed by the data.
+    All blocks start at multiples of 8 bytes.
+    The positions of the blocks are collected in an index,
+    which is written as a side file and becomes the footer
+    of the table file, when the parts are assembled.
+    """
+
+    def __init__(this, filename, table_info):
+        this.filename = filename
+        this.fh = open(filename, "wb")
+        this.columns = table_info.columns
+        this.rows = []
+        this.row_groups = []
+
+    def add_rows(this, rows):
+        this.rows.extend(rows)
+        while len(this.rows) >= row_group_rows:
+            this.write_row_group(this.rows[:row_group_rows])
+            this.rows = this.rows[row_group_rows:]
+
+    def write_block(this, data):
+        offset = this.fh.tell()
+        this.fh.write(data)
+        if len(data) % 8:
+            this.fh.write(b'\0' * (8 - len(data) % 8))
+        return [offset, len(data)]
+
+    def write_array(this, typecode, values):
+        data = array(typecode, values)
+        if sys.byteorder != 'little':
+            data.byteswap()
+        return this.write_block(data.tobytes())
+
+    def write_row_group(this, rows):
+        group = {'rows': len(rows), 'columns': []}
+        for (i, column) in enumerate(this.columns):
+            convert = column.columnar_value
+            values = [convert(row[i]) for row in rows]
+            nulls = bytearray((len(values) + 7) // 8)
+            for (j, v) in enumerate(values):
+                if v is None:
+                    nulls[j >> 3] |= 1 << (j & 7)
+            block = {'nulls': this.write_block(bytes(nulls))}
+            typecode = columnar_typecodes.get(column.columnar_type)
+            if typecode:
+                block['data'] = this.write_array(
+                    typecode, [0 if v is None else v for v in values])
+            else:
+                values = [b'' if v is None else v for v in values]
+                offsets = [0]
+                offsets.extend(itertools.accumulate(map(len, values)))
+                block['offsets'] = this.write_array('Q', offsets)
+                block['data'] = this.write_block(b''.join(values))
+            group['columns'].append(block)
+        this.row_groups.append(group)
+
+    def close(this):
+        if this.rows:
+            this.write_row_group(this.rows)
+            this.rows = []
+        this.raw_bytes = this.written_bytes = this.fh.tell()
+        this.fh.close()
+        with open(this.filename + ".json", "w", encoding='utf-8') as fh:
+            json.dump(this.row_groups, fh)
+
+
+def dump_chunk(ss_cur, chunk):
+    """Dumps the rows of one chunk into its SQL and table part files.
+
+    Returns the timings of the query, of fetching and of writing,
+    the number of rows and the number of bytes
+    before and after the compression.
+    """
+    table = chunk['table']
+    query = "SELECT * FROM `" + str(table) + "`"
+    conditions = []
+    params = []
+    if chunk['lower'] is not None:
+        conditions.append("`" + chunk['column'] + "` >= %s")
+        params.append(chunk['lower'])
+    if chunk['upper'] is not None:
+        conditions.append("`" + chunk['column'] + "` < %s")
+        params.append(chunk['upper'])
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    table_info = catalog[table]
+    sql_fh = OutputFile(part_filename(chunk, 'sql'))
+    if data_format == 'columnar':
+        data_fh = ColumnarWriter(part_filename(chunk, 'col'), table_info)
+    else:
+        # the part of a table with a single chunk becomes the table file,
+        # so it starts with the header
+        data_fh = CsvWriter(part_filename(chunk, 'csv'), table_info,
+                            header=is_single_chunk(chunk))
+
+    stats = {'query_time': 0.0, 'fetch_time': 0.0, 'write_time': 0.0,
+             'rows': 0}
+
+    # the server-side cursor streams the rows,
+    # so only one batch is held in memory at a time
+    inserts = InsertWriter(sql_fh, table_info, max_statement_bytes)
+    start = time.time()
+    ss_cur.execute(query + ";", params)
+    stats['query_time'] = time.time() - start
+    while True:
+        start = time.time()
+        rows = ss_cur.fetchmany(batch_size)
+        fetched = time.time()
+        stats['fetch_time'] += fetched - start
+        if not rows:
+            break
+        data_fh.add_rows(rows)
+        inserts.add_rows(rows)
+        stats['write_time'] += time.time() - fetched
+        stats['rows'] += len(rows)
+
+    start = time.time()
+    inserts.close()
+    data_fh.close()
+    sql_fh.close()
+    stats['write_time'] += time.time() - start
+    stats['raw_bytes'] = sql_fh.raw_bytes + data_fh.raw_bytes
+    stats['bytes'] = sql_fh.written_bytes + data_fh.written_bytes
+    return stats
+
+
+def list_tables(cur):
+    cur.execute("SHOW TABLES")
+    tables = []
+    for table in cur.fetchall():
+        tables.append(table[0])
+    return tables
+
+
+numeric_types = [
+    'tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint',
+    'decimal', 'numeric', 'float', 'double', 'real', 'year']
+integer_types = [
+    'tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint']
+binary_types = [
+    'binary', 'varbinary', 'tinyblob', 'blob', 'mediumblob', 'longblob',
+    'bit', 'geometry', 'point', 'linestring', 'polygon', 'multipoint',
+    'multilinestring', 'multipolygon', 'geometrycollection']
+
+
+class ColumnInfo(object):
+
+    def __init__(this, name, data_type, column_type):
+        this.name = name
+        this.data_type = data_type
+        this.column_type = column_type
+        if data_type in numeric_types:
+            this.csv_format = format_number
+            this.sql_literal = sql_number
+        elif data_type in binary_types:
+            this.csv_format = format_binary
+            this.sql_literal = sql_binary
+        elif data_type == 'time':
+            this.csv_format = format_time
+            this.sql_literal = sql_literal
+        else:
+            this.csv_format = format_value
+            this.sql_literal = sql_literal
+
+        if data_type in integer_types or data_type == 'year':
+            if data_type == 'bigint' and 'unsigned' in column_type:
+                this.columnar_type = 'uint64'
+            else:
+                this.columnar_type = 'int64'
+            this.columnar_value = columnar_number
+        elif data_type in ['float', 'double', 'real']:
+            this.columnar_type = 'float64'
+            this.columnar_value = columnar_number
+        elif data_type == 'date':
+            this.columnar_type = 'date'
+            this.columnar_value = columnar_date
+        elif data_type in ['datetime', 'timestamp']:
+            this.columnar_type = 'timestamp'
+            this.columnar_value = columnar_timestamp
+        elif data_type == 'time':
+            this.columnar_type = 'time'
+            this.columnar_value = columnar_time
+        elif data_type in binary_types:
+            this.columnar_type = 'binary'
+            this.columnar_value = columnar_binary
+        elif data_type in ['decimal', 'numeric']:
+            this.columnar_type = 'decimal'
+            this.columnar_value = columnar_string
+        else:
+            this.columnar_type = 'string'
+            this.columnar_value = columnar_string
+
+
+class TableInfo(object):
+
+    def __init__(this, name):
+        this.name = name
+        this.columns = []
+        this.primary_key = []
+        this.rows = 0
+        this.data_length = 0
+        this.update_time = None
+        this.create = None
+        this.metadata_time = 0.0
+
+    def integer_key(this):
+        """Returns the name of the primary key column,
+        if the table has a primary key of a single integer column."""
+        if len(this.primary_key) != 1:
+            return None
+        for column in this.columns:
+            if column.name == this.primary_key[0] and \
+                    column.data_type in integer_types:
+                return column.name
+        return None
 
-    cur.execute("SHOW CREATE TABLE `" + str(table) + "`;")
-    data += "\n" + str(cur.fetchone()[1]) + ";\n\n"
+
+def load_catalog(cur, tables):
+    """Loads the columns, primary keys and size estimates of all tables
+    with two queries instead of a few queries per table.
+
+    SHOW CREATE TABLE has no bulk equivalent and is still run per table.
+    """
+    catalog = {}
+    for table in tables:
+        catalog[table] = TableInfo(table)
 
     cur.execute(
-        "SELECT `COLUMN_NAME` FROM `INFORMATION_SCHEMA`.`COLUMNS` " +
-        "WHERE `TABLE_SCHEMA`='" + db_name + "' " +
-        "AND `TABLE_NAME`='" + str(table) + "';")
-    columns = []
-    for col in cur.fetchall():
-        columns.append(str(col[0]))
-    table_csv = sep.join(map(format_value, columns)) + "\n"
-
-    cur.execute("SELECT * FROM `" + str(table) + "`;")
-    for row in cur.fetchall():
-        table_csv += sep.join(map(format_value, row)) + "\n"
-        data += "INSERT INTO `" + str(table) + "` VALUES(" + \
-                ', '.join(map(lambda v: '"' + str(v) + '"', row)) + ");\n"
-    data += "\n\n"
+        "SELECT `TABLE_NAME`, `COLUMN_NAME`, `DATA_TYPE`, `COLUMN_TYPE`, " +
+        "`COLUMN_KEY` FROM `INFORMATION_SCHEMA`.`COLUMNS` " +
+        "WHERE `TABLE_SCHEMA`=%s " +
+        "ORDER BY `TABLE_NAME`, `ORDINAL_POSITION`;",
+        (db_name,))
+    for (table, name, data_type, column_type, key) in cur.fetchall():
+        if table not in catalog:
+            continue
+        catalog[table].columns.append(
+            ColumnInfo(name, data_type.lower(), column_type))
+        if key == 'PRI':
+            catalog[table].primary_key.append(name)
+
+    cur.execute(
+        "SELECT `TABLE_NAME`, `TABLE_ROWS`, `DATA_LENGTH`, `UPDATE_TIME` " +
+        "FROM `INFORMATION_SCHEMA`.`TABLES` WHERE `TABLE_SCHEMA`=%s;",
+        (db_name,))
+    for (table, table_rows, data_length, update_time) in cur.fetchall():
+        if table not in catalog:
+            continue
+        catalog[table].rows = table_rows or 0
+        catalog[table].data_length = data_length or 0
+        catalog[table].update_time = update_time
+
+    for table in tables:
+        start = time.time()
+        cur.execute("SHOW CREATE TABLE `" + str(table) + "`;")
+        catalog[table].create = str(cur.fetchone()[1])
+        catalog[table].metadata_time = time.time() - start
+    return catalog
+
+
+def plan_chunks(cur, table_info):
+    """Splits a table into primary key ranges of about chunk_rows rows.
+
+    The first and the last range are open,
+    so every row falls into exactly one chunk.
+    """
+    table = table_info.name
+    table_rows = table_info.rows
+    chunks = []
+
+    def add_chunk(column, lower, upper):
+        chunks.append({
+            'table': table,
+            'index': len(chunks),
+            'column': column,
+            'lower': lower,
+            'upper': upper,
+        })
+
+    column = table_info.integer_key() if table_rows > chunk_rows else None
+    if column:
+        cur.execute(
+            "SELECT MIN(`" + column + "`), MAX(`" + column + "`) " +
+            "FROM `" + str(table) + "`;")
+        (min_key, max_key) = cur.fetchone()
+        if min_key is not None:
+            n = (table_rows + chunk_rows - 1) // chunk_rows
+            step = max(1, (max_key - min_key + n) // n)
+            bounds = list(range(min_key + step, max_key + 1, step))
+            lower = None
+            for upper in bounds:
+                add_chunk(column, lower, upper)
+                lower = upper
+            add_chunk(column, lower, None)
+    if not chunks:
+        add_chunk(None, None, None)
+
+    for chunk in chunks:
+        chunk['size'] = table_info.data_length // len(chunks)
+    return chunks
+
+
+def is_single_chunk(chunk):
+    # only the chunk of a table, which is not split, has no bounds
+    return chunk['lower'] is None and chunk['upper'] is None
+
+
+def chunk_id(chunk):
+    return str(chunk['table']) + ":" + str(chunk['index'])
+
+
+def open_snapshot_connections(n):
+    """Opens n connections, which all read from the same snapshot.
+
+    With more than one connection, the snapshot transactions are started
+    while a global read lock is held, so no write can slip in between them.
+    Without the RELOAD privilege the lock is skipped and
+    the snapshots are only started at nearly the same point in time.
+    A single snapshot is consistent by itself and needs no lock.
+    """
+    lock_con = None
+    locked = False
+    if n > 1:
+        lock_con = connect()
+        lock_cur = lock_con.cursor()
+        try:
+            lock_cur.execute("FLUSH TABLES WITH READ LOCK;")
+            locked = True
+        except pymysql.err.MySQLError as e:
+            print("Warning: could not lock the tables " +
+                  "for a consistent snapshot: " + str(e), file=sys.stderr)
+
+    cons = []
+    for i in range(n):
+        worker_con = connect()
+        worker_cur = worker_con.cursor()
+        worker_cur.execute(
+            "SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+        worker_cur.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT;")
+        worker_cur.close()
+        cons.append(worker_con)
+
+    if lock_con:
+        if locked:
+            lock_cur.execute("UNLOCK TABLES;")
+        lock_cur.close()
+        lock_con.close()
+    return cons
+
+
+class Checkpoint(object):
+    """Records the chunk plan of a dump and the chunks, which are done."""
+
+    def __init__(this, filename, state):
+        this.filename = filename
+        this.state = state
+        this.lock = threading.Lock()
+
+    @staticmethod
+    def load(filename):
+        with open(filename, "r", encoding='utf-8') as fh:
+            return Checkpoint(filename, json.load(fh))
+
+    def is_done(this, chunk):
+        return chunk_id(chunk) in this.state['done']
+
+    def mark_done(this, chunk):
+        with this.lock:
+            this.state['done'].append(chunk_id(chunk))
+            this.save()
+
+    def save(this):
+        # replace the file atomically, so an interruption
+        # never leaves a truncated checkpoint behind
+        tmp_filename = this.filename + ".tmp"
+        with open(tmp_filename, "w", encoding='utf-8') as fh:
+            json.dump(this.state, fh, indent=2)
+        os.replace(tmp_filename, this.filename)
+
+
+def checkpoint_filename():
+    return path.join(target, "dump_" + timestamp + ".checkpoint")
+
+
+def find_checkpoint():
+    """Finds the checkpoint of the last interrupted dump of the database."""
+    for filename in sorted(
+            glob.glob(path.join(target, "dump_*.checkpoint")), reverse=True):
+        checkpoint = Checkpoint.load(filename)
+        if checkpoint.state['database'] == db_name:
+            return checkpoint
+    return None
+
+
+def parts_dir():
+    return path.join(target, "parts_" + timestamp)
+
+
+def part_filename(chunk, ext):
+    return path.join(
+        parts_dir(),
+        str(chunk['table']) + "_" + str(chunk['index']) + "." + ext)
+
+
+progress_lock = threading.Lock()
+progress = {'done': 0}
+
+
+def report_progress(chunk, stats):
+    with progress_lock:
+        progress['done'] += 1
+        sys.stderr.write(
+            "[{}/{}] {} #{}: {} rows, {:.1f} MB in {:.1f} s ".format(
+                progress['done'], len(pending), chunk['table'], chunk['index'],
+                stats['rows'], stats['bytes'] / 1e6, stats['time']) +
+            "({:.0f} rows/s)\n".format(
+                stats['rows'] / stats['time'] if stats['time'] > 0 else 0.0))
+        sys.stderr.flush()
+
+
+def per_second(amount, seconds):
+    return amount / seconds if seconds > 0 else None
+
 
-    filename = path.join(target, "table_" + timestamp + "_" + str(table) + ".csv")
-    fh = open(filename, "w")
-    fh.write(table_csv)
-    fh.close()
+def build_report():
+    """Builds the machine-readable report of the dump
+    with the timings and the throughput per table."""
+    report = {
+        'database': db_name,
+        'timestamp': timestamp,
+        'jobs': len(workers),
+        'catalog_time': catalog_time,
+        'dump_time': dump_time,
+        'assembly_time': assembly_time,
+        'total_time': time.time() - start,
+        'tables': {},
+    }
+    for table in tables:
+        table_stats = {
+            'skipped': table in unchanged,
+            'chunks': 0,
+            'metadata_time': catalog[table].metadata_time,
+            'query_time': 0.0,
+            'fetch_time': 0.0,
+            'write_time': 0.0,
+            'time': 0.0,
+            'rows': 0,
+            'raw_bytes': 0,
+            'bytes': 0,
+        }
+        for chunk in chunks:
+            stats = chunk_stats.get(chunk_id(chunk))
+            if chunk['table'] != table or not stats:
+                continue
+            table_stats['chunks'] += 1
+            for key in ['query_time', 'fetch_time', 'write_time', 'time',
+                        'rows', 'raw_bytes', 'bytes']:
+                table_stats[key] += stats[key]
+        table_stats['rows_per_second'] = \
+            per_second(table_stats['rows'], table_stats['time'])
+        table_stats['bytes_per_second'] = \
+            per_second(table_stats['bytes'], table_stats['time'])
+        report['tables'][table] = table_stats
+    return report
 
+
+def dump_worker(worker_con, work, checkpoint, chunk_stats, errors):
+    ss_cur = worker_con.cursor(pymysql.cursors.SSCursor)
+    try:
+        while not errors:
+            try:
+                chunk = work.get_nowait()
+            except queue.Empty:
+                break
+            start = time.time()
+            stats = dump_chunk(ss_cur, chunk)
+            stats['time'] = time.time() - start
+            chunk_stats[chunk_id(chunk)] = stats
+            checkpoint.mark_done(chunk)
+            report_progress(chunk, stats)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        ss_cur.close()
+        worker_con.commit()
+        worker_con.close()
+
+
+def load_fingerprints(cur, tables):
+    """Builds a fingerprint for every table, which changes with its content.
+
+    A fingerprint with a None value can not tell,
+    if the table changed, and never matches.
+    """
+    fingerprints = {}
+    for table in tables:
+        fingerprints[table] = {
+            'schema': hashlib.sha1(
+                catalog[table].create.encode('utf-8')).hexdigest(),
+        }
+    if not tables:
+        return fingerprints
+
+    if args.fingerprint == 'checksum':
+        cur.execute("CHECKSUM TABLE " +
+                    ", ".join(["`" + str(t) + "`" for t in tables]) + ";")
+        checksums = {}
+        for (name, checksum) in cur.fetchall():
+            checksums[name.split('.', 1)[-1]] = checksum
+        for table in tables:
+            fingerprints[table]['checksum'] = checksums.get(table)
+    else:
+        for table in tables:
+            table_info = catalog[table]
+            fingerprints[table]['update_time'] = \
+                str(table_info.update_time) if table_info.update_time else None
+            fingerprints[table]['rows'] = table_info.rows
+            fingerprints[table]['data_length'] = table_info.data_length
+    return fingerprints
+
+
+def manifest_filename():
+    return path.join(target, "manifest_" + str(db_name) + ".json")
+
+
+def load_manifest():
+    if not path.isfile(manifest_filename()):
+        return None
+    with open(manifest_filename(), "r", encoding='utf-8') as fh:
+        return json.load(fh)
+
+
+def save_manifest(manifest):
+    tmp_filename = manifest_filename() + ".tmp"
+    with open(tmp_filename, "w", encoding='utf-8') as fh:
+        json.dump(manifest, fh, indent=2)
+    os.replace(tmp_filename, manifest_filename())
+
+
+def find_unchanged_tables(manifest, fingerprints):
+    """Finds the tables with the same fingerprint as in the last dump,
+    whose files are still present."""
+    if not manifest:
+        return []
+    unchanged = []
+    for (table, fingerprint) in fingerprints.items():
+        entry = manifest['tables'].get(table)
+        if not entry or None in fingerprint.values():
+            continue
+        if entry['fingerprint'] != fingerprint or \
+                manifest.get('compress') != compress or \
+                manifest.get('format') != data_format:
+            continue
+        if not path.isfile(path.join(target, entry['sql'])) or \
+                not path.isfile(path.join(target, entry['data'])):
+            continue
+        unchanged.append(table)
+    return unchanged
+
+
+def copy_range(filename, offset, length, fh):
+    with open(filename, "rb") as src_fh:
+        src_fh.seek(offset)
+        while length > 0:
+            block = src_fh.read(min(length, 1024 * 1024))
+            if not block:
+                break
+            fh.write(block)
+            length -= len(block)
+
+
+def link_file(src, dst):
+    """Hard links the file of an unchanged table, or copies it,
+    if the file system does not support hard links."""
+    if path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def write_table_schema(table, statement, sql_fh):
+    sql_fh.write(encode_member(
+        "DROP TABLE IF EXISTS `" + str(table) + "`;" +
+        "\n" + statement + ";\n\n"))
+
+
+def csv_header(table_info):
+    columns = [column.name for column in table_info.columns]
+    return sep.join(map(format_value, columns)) + "\n"
+
+
+def write_csv_header(table_info, csv_fh):
+    csv_fh.write(encode_member(csv_header(table_info)))
+
+
+def write_columnar(table_info, table_chunks, fh):
+    """Assembles the columnar part files of a table into one file.
+
+    The file starts with a magic number, followed by the row groups,
+    the JSON footer, the length of the footer as 64 bit little-endian
+    integer and the magic number again.
+    """
+    fh.write(columnar_magic)
+    row_groups = []
+    for chunk in table_chunks:
+        base = fh.tell()
+        index_filename = part_filename(chunk, 'col.json')
+        with open(index_filename, "r", encoding='utf-8') as index_fh:
+            groups = json.load(index_fh)
+        os.remove(index_filename)
+        append_part(chunk, 'col', fh)
+        for group in groups:
+            for block in group['columns']:
+                for position in block.values():
+                    position[0] += base
+            row_groups.append(group)
+    footer = json.dumps({
+        'columns': [{'name': c.name,
+                     'type': c.columnar_type,
+                     'mysql_type': c.column_type}
+                    for c in table_info.columns],
+        'row_groups': row_groups,
+    }).encode('utf-8')
+    fh.write(footer)
+    fh.write(struct.pack('<Q', len(footer)))
+    fh.write(columnar_magic)
+
+
+def copy_file(src_fh, fh):
+    """Appends a file to an open file.
+
+    The bytes are copied by the kernel, without passing them
+    through the process, if the platform supports it.
+    """
+    fh.flush()
+    size = os.fstat(src_fh.fileno()).st_size
+    copied = 0
+    try:
+        while copied < size:
+            if hasattr(os, 'copy_file_range'):
+                n = os.copy_file_range(
+                    src_fh.fileno(), fh.fileno(), size - copied)
+            else:
+                n = os.sendfile(
+                    fh.fileno(), src_fh.fileno(), None, size - copied)
+            if n == 0:
+                break
+            copied += n
+    except (AttributeError, OSError):
+        # e.g. copy_file_range between file systems on older kernels
+        src_fh.seek(copied)
+        fh.seek(0, os.SEEK_END)
+        shutil.copyfileobj(src_fh, fh)
+    # the file object does not know the position behind the copied bytes
+    fh.seek(0, os.SEEK_END)
+
+
+def append_part(chunk, ext, fh):
+    with open(part_filename(chunk, ext), "rb") as part_fh:
+        copy_file(part_fh, fh)
+    os.remove(part_filename(chunk, ext))
+
+
+start = time.time()
+con = connect()
+cur = con.cursor()
+tables = list_tables(cur)
+cur.execute("SELECT @@max_allowed_packet;")
+# leave some room for the protocol overhead of the packet
+max_statement_bytes = max(
+    1024, min(max_statement_bytes, int(cur.fetchone()[0]) - 1024))
+
+checkpoint = find_checkpoint() if args.resume else None
+if args.resume and not checkpoint:
+    print("No checkpoint found, starting a new dump.")
+if checkpoint:
+    timestamp = checkpoint.state['timestamp']
+    tables = checkpoint.state['tables']
+    compress = checkpoint.state['compress']
+    compress_level = checkpoint.state['compress_level']
+    # the resumed chunks are written in the format of the finished ones
+    data_format = checkpoint.state.get('format', data_format)
+    row_group_rows = checkpoint.state.get('row_group_rows', row_group_rows)
+    catalog = load_catalog(cur, tables)
+    catalog_time = time.time() - start
+    print("Resuming the dump from " + timestamp + ". " +
+          "The resumed chunks are read from a new snapshot.")
+else:
+    fingerprints = None
+    unchanged = []
+    catalog = load_catalog(cur, tables)
+    catalog_time = time.time() - start
+    if args.incremental:
+        fingerprints = load_fingerprints(cur, tables)
+        unchanged = find_unchanged_tables(load_manifest(), fingerprints)
+    chunks = []
+    for table in tables:
+        if table not in unchanged:
+            chunks.extend(plan_chunks(cur, catalog[table]))
+    checkpoint = Checkpoint(checkpoint_filename(), {
+        'database': db_name,
+        'timestamp': timestamp,
+        'tables': tables,
+        'compress': compress,
+        'compress_level': compress_level,
+        'format': data_format,
+        'row_group_rows': row_group_rows,
+        'fingerprints': fingerprints,
+        'unchanged': unchanged,
+        'chunks': chunks,
+        'done': [],
+    })
+    if not path.isdir(parts_dir()):
+        os.makedirs(parts_dir())
+    checkpoint.save()
 cur.close()
 con.close()
 
-filename = path.join(target, "backup_" + timestamp + ".sql")
-fh = open(filename, "w")
-fh.write(data)
-fh.close()
+chunks = checkpoint.state['chunks']
+
+# the work queue is filled largest chunk first,
+# so the longest running dumps do not start last
+work = queue.Queue()
+pending = [chunk for chunk in chunks if not checkpoint.is_done(chunk)]
+for chunk in sorted(pending, key=lambda c: c['size'], reverse=True):
+    work.put(chunk)
+
+chunk_stats = {}
+errors = []
+dump_start = time.time()
+workers = []
+if pending:
+    for worker_con in open_snapshot_connections(min(jobs, len(pending))):
+        worker = threading.Thread(
+            target=dump_worker,
+            args=(worker_con, work, checkpoint, chunk_stats, errors))
+        worker.start()
+        workers.append(worker)
+for worker in workers:
+    worker.join()
+if errors:
+    raise errors[0]
+dump_time = time.time() - dump_start
+
+fingerprints = checkpoint.state['fingerprints']
+unchanged = checkpoint.state['unchanged']
+manifest = load_manifest() if unchanged else None
+new_manifest = {
+    'database': db_name,
+    'timestamp': timestamp,
+    'fingerprint': args.fingerprint,
+    'compress': compress,
+    'format': data_format,
+    'tables': {},
+}
+
+schema = {
+    'database': db_name,
+    'timestamp': timestamp,
+    'tables': [],
+}
+
+# the part files are assembled into the files of the dump,
+# which takes part of the time of the dump
+assembly_start = time.time()
+sql_name = output_name("backup_" + timestamp + ".sql")
+sql_fh = open(path.join(target, sql_name), "wb")
+# like mysqldump, a 0 in an AUTO_INCREMENT column is kept,
+# and the backslash escapes of the literals are not switched off
+sql_fh.write(encode_member(
+    "SET NAMES utf8mb4;\n" +
+    "SET @OLD_SQL_MODE=@@SQL_MODE, SQL_MODE='NO_AUTO_VALUE_ON_ZERO';\n" +
+    "SET FOREIGN_KEY_CHECKS=0;\n" +
+    "SET UNIQUE_CHECKS=0;\n" +
+    "SET AUTOCOMMIT=0;\n\n"))
+for table in tables:
+    if data_format == 'columnar':
+        data_name = "table_" + timestamp + "_" + str(table) + ".col"
+    else:
+        data_name = output_name(
+            "table_" + timestamp + "_" + str(table) + ".csv")
+    offset = sql_fh.tell()
+    if table in unchanged:
+        # take the section and the table file of the last dump
+        entry = manifest['tables'][table]
+        copy_range(path.join(target, entry['sql']),
+                   entry['sql_offset'], entry['sql_length'], sql_fh)
+        link_file(path.join(target, entry['data']),
+                  path.join(target, data_name))
+    else:
+        write_table_schema(table, catalog[table].create, sql_fh)
+        table_chunks = [chunk for chunk in chunks if chunk['table'] == table]
+        for chunk in table_chunks:
+            append_part(chunk, 'sql', sql_fh)
+        sql_fh.write(encode_member("\n\n"))
+        if data_format != 'columnar' and len(table_chunks) == 1:
+            # the part file already is the complete table file
+            os.replace(part_filename(table_chunks[0], 'csv'),
+                       path.join(target, data_name))
+        else:
+            data_fh = open(path.join(target, data_name), "wb")
+            if data_format == 'columnar':
+                write_columnar(catalog[table], table_chunks, data_fh)
+            else:
+                write_csv_header(catalog[table], data_fh)
+                for chunk in table_chunks:
+                    append_part(chunk, 'csv', data_fh)
+            data_fh.close()
+    schema['tables'].append({
+        'name': table,
+        'create': catalog[table].create,
+        'columns': [{'name': c.name, 'type': c.data_type}
+                    for c in catalog[table].columns],
+        data_format: data_name,
+    })
+    if fingerprints:
+        new_manifest['tables'][table] = {
+            'fingerprint': fingerprints[table],
+            'sql': sql_name,
+            'sql_offset': offset,
+            'sql_length': sql_fh.tell() - offset,
+            'data': data_name,
+        }
+sql_fh.write(encode_member(
+    "COMMIT;\n" +
+    "SET UNIQUE_CHECKS=1;\n" +
+    "SET FOREIGN_KEY_CHECKS=1;\n" +
+    "SET SQL_MODE=@OLD_SQL_MODE;\n"))
+sql_fh.close()
+assembly_time = time.time() - assembly_start
+
+# the schema file lets mysqlrestore create the tables
+# without parsing the SQL dump
+with open(path.join(target, "schema_" + timestamp + ".json"),
+          "w", encoding='utf-8') as fh:
+    json.dump(schema, fh, indent=2)
+
+if fingerprints:
+    save_manifest(new_manifest)
+
+with open(path.join(target, "report_" + timestamp + ".json"),
+          "w", encoding='utf-8') as fh:
+    json.dump(build_report(), fh, indent=2)
+
+os.rmdir(parts_dir())
+os.remove(checkpoint.filename)
+
+wall_time = dump_time + assembly_time
+chunk_time = sum([stats['time'] for stats in chunk_stats.values()])
+raw_bytes = sum([stats['raw_bytes'] for stats in chunk_stats.values()])
+written_bytes = sum([stats['bytes'] for stats in chunk_stats.values()])
+if unchanged:
+    print("Took {} unchanged tables from the last dump.".format(len(unchanged)))
+if pending:
+    print("Dumped {} chunks of {} tables with {} jobs in {:.1f} s ".format(
+              len(pending), len(tables) - len(unchanged), len(workers),
+              wall_time) +
+          "(assembly {:.1f} s, sum of chunk times {:.1f} s, ".format(
+              assembly_time, chunk_time) +
+          "speedup {:.2f}x)".format(
+              chunk_time / wall_time if wall_time > 0 else 1.0))
+if pending and compress:
+    print("Compressed {:.1f} MB to {:.1f} MB with {} ".format(
+              raw_bytes / 1e6, written_bytes / 1e6, compress) +
+          "(ratio {:.2f}, {:.1f} MB/s)".format(
+              raw_bytes / written_bytes if written_bytes > 0 else 1.0,
+              raw_bytes / 1e6 / wall_time if wall_time > 0 else 0.0))
+elif pending:
+    print("Wrote {:.1f} MB ({:.1f} MB/s)".format(
+              written_bytes / 1e6,
+              written_bytes / 1e6 / wall_time if wall_time > 0 else 0.0))
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+# Tobias Kiertscher <dev@mastersign.de>
+
+import pymysql
+import os
+from os import path
+import re
+import argparse
+import json
+import glob
+import gzip
+import bz2
+import lzma
+import shutil
+import tempfile
+import threading
+import queue
+import time
+from getpass import getpass
+
+parser = argparse.ArgumentParser(
+    description='restoring a MySQL dump of mysqldump from its CSV files')
+parser.add_argument(
+    '-s', '--server',
+    default='localhost',
+    help='The name or IP address of the MySQL server.')
+parser.add_argument(
+    '-p', '--port',
+    default=3306,
+    type=int,
+    help='The port to connect to.')
+parser.add_argument(
+    '-u', '--user',
+    default='root',
+    help='The username for the login.')
+parser.add_argument(
+    '-pw', '--password',
+    help='The password for the login.')
+parser.add_argument(
+    '-db', '--database',
+    help='The database or schema to restore into. ' +
+         'Default is the schema of the dump.')
+parser.add_argument(
+    '-t', '--target',
+    default=path.join(path.dirname(__file__), "data"),
+    help='The directory with the dump files.')
+parser.add_argument(
+    '-ts', '--timestamp',
+    help='The timestamp of the dump to restore. Default is the latest dump.')
+parser.add_argument(
+    '-j', '--jobs',
+    default=4,
+    type=int,
+    help='The number of tables to load concurrently, ' +
+         'each over its own connection.')
+args = parser.parse_args()
+
+db_host = args.server
+db_port = args.port
+db_user = args.user
+db_passwd = args.password
+target = args.target
+jobs = max(1, args.jobs)
+if not db_passwd:
+    db_passwd = getpass('Password: ')
+
+
+def find_schema_file():
+    if args.timestamp:
+        return path.join(target, "schema_" + args.timestamp + ".json")
+    filenames = sorted(glob.glob(path.join(target, "schema_*.json")))
+    if not filenames:
+        print("No dump found in " + target)
+        exit(1)
+    return filenames[-1]
+
+
+with open(find_schema_file(), "r", encoding='utf-8') as fh:
+    schema = json.load(fh)
+db_name = args.database or schema['database']
+if any(['csv' not in table for table in schema['tables']]):
+    print("Only dumps with CSV files can be restored.")
+    exit(1)
+
+
+def connect():
+    return pymysql.connect(host=db_host, port=db_port,
+                           user=db_user, passwd=db_passwd, db=db_name,
+                           charset='utf8mb4', local_infile=True)
+
+
+def is_view(statement):
+    return re.match(
+        r'CREATE\s+(ALGORITHM\s*=\s*\w+\s+)?(DEFINER\s*=\s*\S+\s+)?' +
+        r'(SQL\s+SECURITY\s+\w+\s+)?VIEW', statement) is not None
+
+
+def split_create_statement(statement):
+    """Splits the secondary indexes and the foreign keys
+    from a CREATE TABLE statement.
+
+    Returns the statement without them, the index definitions
+    and the foreign key definitions.
+    Indexes on an AUTO_INCREMENT column are kept,
+    because MySQL requires a key for it.
+    The table options start at the first line with a closing parenthesis,
+    they are followed by the partitions of a partitioned table.
+    """
+    lines = statement.split('\n')
+    end = next((i for (i, line) in enumerate(lines)
+                if i > 0 and line.startswith(')')), len(lines) - 1)
+    auto_columns = [m.group(1) for m in
+                    [re.match(r'\s+`([^`]+)`.*\sAUTO_INCREMENT', line)
+                     for line in lines] if m]
+    kept = []
+    indexes = []
+    foreign_keys = []
+    for line in lines[1:end]:
+        definition = line.strip().rstrip(',')
+        if re.match(r'(UNIQUE |FULLTEXT |SPATIAL )?KEY ', definition) and \
+                not any(['`' + c + '`' in definition for c in auto_columns]):
+            indexes.append(definition)
+        elif re.match(r'CONSTRAINT .* FOREIGN KEY ', definition):
+            foreign_keys.append(definition)
+        else:
+            kept.append('  ' + definition)
+    create = lines[0] + '\n' + ',\n'.join(kept) + '\n' + \
+        '\n'.join(lines[end:])
+    return (create, indexes, foreign_keys)
+
+
+binary_types = [
+    'binary', 'varbinary', 'tinyblob', 'blob', 'mediumblob', 'longblob',
+    'bit', 'geometry', 'point', 'linestring', 'polygon', 'multipoint',
+    'multilinestring', 'multipolygon', 'geometrycollection']
+
+
+def column_mapping(columns):
+    """Builds the column list and the SET clause for LOAD DATA.
+
+    Binary columns are written as hex digits by mysqldump
+    and are decoded with UNHEX().
+    """
+    targets = []
+    assignments = []
+    for (i, column) in enumerate(columns):
+        if column['type'] in binary_types:
+            targets.append("@v" + str(i))
+            assignments.append(
+                "`" + column['name'] + "`=UNHEX(@v" + str(i) + ")")
+        else:
+            targets.append("`" + column['name'] + "`")
+    mapping = " (" + ", ".join(targets) + ")"
+    if assignments:
+        mapping += " SET " + ", ".join(assignments)
+    return mapping
+
+
+decompressors = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+
+def load_csv(cur, table, columns, filename):
+    """Loads a CSV file of mysqldump with LOAD DATA LOCAL INFILE.
+
+    Compressed files are decompressed into a temporary file first,
+    because the server reads the file by its name.
+    """
+    (base, ext) = path.splitext(filename)
+    tmp_filename = None
+    if ext in decompressors:
+        tmp_fh = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        with decompressors[ext](filename, "rb") as src_fh:
+            shutil.copyfileobj(src_fh, tmp_fh, 1024 * 1024)
+        tmp_fh.close()
+        tmp_filename = tmp_fh.name
+    try:
+        cur.execute(
+            "LOAD DATA LOCAL INFILE %s INTO TABLE `" + table + "` " +
+            "CHARACTER SET utf8mb4 " +
+            "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' " +
+            "ESCAPED BY '' LINES TERMINATED BY '\\n' IGNORE 1 LINES" +
+            column_mapping(columns) + ";",
+            (tmp_filename or filename,))
+    finally:
+        if tmp_filename:
+            os.remove(tmp_filename)
+
+
+def run_workers(tasks, f):
+    """Runs f(cur, task) for all tasks on a pool of connections."""
+    work = queue.Queue()
+    for task in tasks:
+        work.put(task)
+    errors = []
+
+    def worker():
+        con = connect()
+        cur = con.cursor()
+        try:
+            cur.execute("SET FOREIGN_KEY_CHECKS=0;")
+            cur.execute("SET UNIQUE_CHECKS=0;")
+            # a 0 in an AUTO_INCREMENT column is kept, like in the dump
+            cur.execute("SET SQL_MODE='NO_AUTO_VALUE_ON_ZERO';")
+            while not errors:
+                try:
+                    task = work.get_nowait()
+                except queue.Empty:
+                    break
+                f(cur, task)
+                con.commit()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            cur.close()
+            con.close()
+
+    threads = []
+    for i in range(min(jobs, len(tasks))):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+start = time.time()
+
+tables = []
+views = []
+indexes = {}
+foreign_keys = {}
+con = connect()
+cur = con.cursor()
+cur.execute("SET FOREIGN_KEY_CHECKS=0;")
+for table in schema['tables']:
+    name = table['name']
+    if is_view(table['create']):
+        views.append(table)
+        continue
+    (create, indexes[name], foreign_keys[name]) = \
+        split_create_statement(table['create'])
+    cur.execute("DROP TABLE IF EXISTS `" + name + "`;")
+    cur.execute(create)
+    tables.append(table)
+print("Created {} tables".format(len(tables)))
+
+# the largest files are loaded first,
+# so the longest running loads do not start last
+tables.sort(key=lambda t: path.getsize(path.join(target, t['csv'])),
+            reverse=True)
+run_workers(tables, lambda cur, t: load_csv(
+    cur, t['name'], t['columns'], path.join(target, t['csv'])))
+load_time = time.time() - start
+print("Loaded {} tables in {:.1f} s".format(len(tables), load_time))
+
+# building the indexes after loading the data is much faster,
+# than updating them with every row
+run_workers(
+    [t['name'] for t in tables if indexes[t['name']]],
+    lambda cur, name: cur.execute(
+        "ALTER TABLE `" + name + "` " +
+        ", ".join(["ADD " + d for d in indexes[name]]) + ";"))
+run_workers(
+    [t['name'] for t in tables if foreign_keys[t['name']]],
+    lambda cur, name: cur.execute(
+        "ALTER TABLE `" + name + "` " +
+        ", ".join(["ADD " + d for d in foreign_keys[name]]) + ";"))
+
+for view in views:
+    cur.execute("DROP VIEW IF EXISTS `" + view['name'] + "`;")
+    cur.execute(view['create'])
+cur.close()
+con.close()
+
+print("Restored {} tables and {} views in {:.1f} s ".format(
+          len(tables), len(views), time.time() - start) +
+      "(indexes and foreign keys in {:.1f} s)".format(
+          time.time() - start - load_time))
@@ -2,26 +2,44 @@
 
 # Tobias Kiertscher <dev@mastersign.de>
 
-from sys import stdin
+from sys import stdin, stdout, stderr
+import os
+from os import path
 import re
+import json
+import base64
+import datetime
+import decimal
+import math
+import csv
+import zlib
+import hashlib
+import time
+import threading
+import unicodedata
+import queue
 import argparse
+import socket
+import struct
 from getpass import getpass
 import psycopg2
-import prettytable
 
 def_user = 'postgres'
 def_password = ''
 
-supported_formats = ['table', 'csv', 'tsv', 'html', 'md_table', 'md_list']
+supported_formats = ['table', 'csv', 'tsv', 'html', 'md_table', 'md_list',
+                     'ndjson', 'binary']
 
 parser = argparse.ArgumentParser(
     description='running an SQL query against a PostgreSQL database')
 
 parser.add_argument(
     'host',
+    nargs='?',
     help='The name or IP address of the server.')
 parser.add_argument(
     'dbname',
+    nargs='?',
     help='The name of the database.')
 parser.add_argument(
     '-u', '--user',
@@ -56,27 +74,134 @@ parser.add_argument(
     default=[],
     help='A number of arguments to inject into the SQL statement.\n' +
          'Every argument is given as a key-value-pair: KEY=VALUE.')
-
-cl_args = parser.parse_args()
-password = cl_args.password
-if not password:
-    if cl_args.user == def_user:
-        password = def_password
-    else:
-        if cl_args.file:
-            password = getpass('Password: ')
-        else:
-            print('You must either specify the password ' +
-                  'as a command line argument, ' +
-                  'or a SQL file as input.')
-            exit(1)
-
-if cl_args.format not in supported_formats:
-    print(
-        'You must use an output format from the following list: ' +
-        ', '.join(supported_formats))
-    exit(1)
-
+parser.add_argument(
+    '-bs', '--batch-size',
+    default=2000,
+    type=int,
+    help='The number of rows to fetch from the server at once. ' +
+         'A single SELECT statement is read through a server-side cursor ' +
+         'in batches of this size.')
+parser.add_argument(
+    '-pl', '--pipeline',
+    default=0,
+    type=int,
+    help='The number of batches of rows to fetch ahead in a separate ' +
+         'thread, while the rows are formatted. ' +
+         'Default is 0, which fetches and formats one after another.')
+parser.add_argument(
+    '-ntc', '--no-type-cache',
+    action='store_true',
+    help='A switch for deactivating the cache of column type names ' +
+         'in ~/.cache/pgquery.')
+parser.add_argument(
+    '-nc', '--no-copy',
+    action='store_true',
+    help='A switch for deactivating COPY TO STDOUT ' +
+         'for the formats csv and tsv. ' +
+         'The rows are formatted by pgquery in the same dialect.')
+parser.add_argument(
+    '-i', '--inventory',
+    type=argparse.FileType('r'),
+    help='A file with one host and database name per line. ' +
+         'The query is run against all of them and the results ' +
+         'are written with an additional column source.')
+parser.add_argument(
+    '-j', '--parallel',
+    default=8,
+    type=int,
+    help='The number of targets of the inventory ' +
+         'to query at the same time.')
+parser.add_argument(
+    '-sw', '--sweep',
+    type=argparse.FileType('r'),
+    help='A CSV file with a header line or an NDJSON file ' +
+         'with a set of query arguments per row. ' +
+         'The query is prepared once and executed for every row, ' +
+         'the arguments are written as additional columns.')
+parser.add_argument(
+    '-cmp', '--compare',
+    nargs=2,
+    metavar=('HOST', 'DBNAME'),
+    help='A second server and database to run the query against. ' +
+         'The results are compared and the ranges of differing keys ' +
+         'are written. The query must be ordered by the key columns, ' +
+         'in the order of Python values (e.g. COLLATE "C" for text).')
+parser.add_argument(
+    '-k', '--key',
+    nargs='+',
+    help='The key columns for the comparison. ' +
+         'Default is the first column.')
+parser.add_argument(
+    '-cc', '--compare-chunk',
+    default=1000,
+    type=int,
+    help='The number of rows, which are compared by their hash at once.')
+parser.add_argument(
+    '-ed', '--export-dir',
+    help='A directory to write the bytea columns and the large objects ' +
+         'to, one file per row and column, named after the key column. ' +
+         'The file names are written instead of the values. ' +
+         'A whole batch of bytea values is held in memory, ' +
+         'so use a small batch size for large values.')
+parser.add_argument(
+    '-ek', '--export-key',
+    help='The key column for the names of the exported files. ' +
+         'Default is the first column.')
+parser.add_argument(
+    '-lo', '--large-objects',
+    nargs='+',
+    default=[],
+    help='The columns with the OIDs of large objects to export. ' +
+         'Large objects are streamed to the files in chunks.')
+parser.add_argument(
+    '-ct', '--cache-ttl',
+    default=0,
+    type=int,
+    help='The number of seconds to cache the result of a single SELECT ' +
+         'statement in ~/.cache/pgquery/results. ' +
+         'A cached result is written without connecting to the server. ' +
+         'Default is 0, which deactivates the cache.')
+parser.add_argument(
+    '-cs', '--cache-size',
+    default=64,
+    type=int,
+    help='The maximum size of the result cache in MB. ' +
+         'The least recently used results are removed first.')
+parser.add_argument(
+    '-pr', '--profile',
+    action='store_true',
+    help='A switch for activating a summary of the time spent ' +
+         'in the phases of the query on stderr.')
+parser.add_argument(
+    '-prj', '--profile-json',
+    help='A file to write the profile of the query to, as JSON.')
+parser.add_argument(
+    '-ex', '--explain',
+    action='store_true',
+    help='A switch for activating the output of ' +
+         'EXPLAIN (ANALYZE, BUFFERS) for a single SELECT statement ' +
+         'with the profile. The statement is executed twice.')
+parser.add_argument(
+    '--serve',
+    nargs='?',
+    const='',
+    metavar='SOCKET',
+    help='Runs a session server on a Unix socket, which keeps ' +
+         'the connections open for the requests of pgsession. ' +
+         'Default socket is $XDG_RUNTIME_DIR/pgquery.sock.')
+parser.add_argument(
+    '-it', '--idle-timeout',
+    default=300,
+    type=int,
+    help='The number of seconds the session server ' +
+         'keeps an idle connection open.')
+parser.add_argument(
+    '-ts', '--table-sample',
+    default=1000,
+    type=int,
+    help='The number of rows, which determine the column widths ' +
+         'in the format table. Longer text in later rows is split ' +
+         'into lines, longer numbers overflow their column.')
 
 class Column(object):
 
@@ -85,32 +210,723 @@ class Column(object):
         this.type = col_type
 
 
-def process_result_format(conn, cur):
+class OutputWriter(object):
+    """A buffered binary output.
+
+    Text is encoded as UTF-8 and the written bytes are counted.
+    """
+
+    def __init__(this, fh, buffer_size=256 * 1024):
+        this.fh = fh
+        this.buffer_size = buffer_size
+        this.chunks = []
+        this.buffered = 0
+        this.bytes = 0
+
+    def write(this, data):
+        this.chunks.append(data)
+        this.buffered += len(data)
+        this.bytes += len(data)
+        if this.buffered >= this.buffer_size:
+            this.flush()
+
+    def text(this, text):
+        this.write(text.encode('utf-8'))
+
+    def line(this, text=''):
+        this.write((text + '\n').encode('utf-8'))
+
+    def flush(this):
+        if this.chunks:
+            this.fh.write(b''.join(this.chunks))
+            this.chunks = []
+            this.buffered = 0
+        this.fh.flush()
+
+
+type_cache_dir = path.join(
+    os.environ.get('XDG_CACHE_HOME') or
+    path.join(path.expanduser('~'), '.cache'),
+    'pgquery')
+# OIDs below this value belong to the built-in types of the server,
+# they only change with the server version
+first_normal_oid = 16384
+# the user defined types are looked up again after one day
+type_cache_ttl = 24 * 60 * 60
+
+
+def type_cache_file(host, dbname):
+    name = re.sub(r'[^\w.-]', '_', '{0}_{1}'.format(host, dbname))
+    return path.join(type_cache_dir, 'types_{0}.json'.format(name))
+
+
+def load_type_cache(filename, server_version):
+    """Loads the cached type names of a database as a dict
+    from the OID to a pair of type name and lookup time.
+
+    The cache is dropped if the server version changed,
+    expired user defined types are left out."""
+    try:
+        with open(filename, 'r', encoding='utf-8') as fh:
+            data = json.load(fh)
+    except (IOError, ValueError):
+        return {}
+    if data.get('server_version') != server_version:
+        return {}
+    now = time.time()
+    return {int(oid): entry for (oid, entry) in data['types'].items()
+            if int(oid) < first_normal_oid or
+            now - entry[1] < type_cache_ttl}
+
+
+def save_type_cache(filename, server_version, type_cache):
+    data = {
+        'server_version': server_version,
+        'types': {str(oid): entry for (oid, entry) in type_cache.items()},
+    }
+    try:
+        os.makedirs(path.dirname(filename), exist_ok=True)
+        tmp_filename = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(tmp_filename, 'w', encoding='utf-8') as fh:
+            json.dump(data, fh)
+        os.replace(tmp_filename, filename)
+    except OSError:
+        # the cache is only an optimization
+        pass
 
-    def process_column(col):
-        name = col.name
 
-        type_cur = conn.cursor()
-        type_cur.execute(
-            """
-            SELECT typname FROM pg_type AS t
-            JOIN pg_namespace AS n ON t.typnamespace = n.oid
-            WHERE t.oid = %(oid)s
-            """,
-            {'oid': col.type_code})
-        type_name = type_cur.fetchone()[0]
-        type_cur.close()
+result_cache_dir = path.join(type_cache_dir, 'results')
 
-        return Column(name, type_name)
 
-    return map(process_column, cur.description)
+def result_cache_key(host, dbname, user, query, query_params):
+    # the query arguments are strings,
+    # so they determine the mogrified query
+    key = json.dumps([host, dbname, user, query,
+                      sorted(query_params.items())])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
 
 
-def iterate_rows(cur, cache, f):
-    row = cur.fetchone()
-    while row:
-        f(cache, row)
-        row = cur.fetchone()
+def cache_value(v):
+    """Encodes a value of a row for JSON,
+    the types, which JSON does not have, are tagged."""
+    if v is None or isinstance(v, (bool, int, str)):
+        return v
+    if isinstance(v, float):
+        return v if math.isfinite(v) else {'$': 'float', 'v': repr(v)}
+    if isinstance(v, decimal.Decimal):
+        return {'$': 'decimal', 'v': str(v)}
+    if isinstance(v, datetime.datetime):
+        return {'$': 'datetime', 'v': v.isoformat()}
+    if isinstance(v, datetime.date):
+        return {'$': 'date', 'v': v.isoformat()}
+    if isinstance(v, datetime.time):
+        return {'$': 'time', 'v': v.isoformat()}
+    if isinstance(v, datetime.timedelta):
+        return {'$': 'timedelta', 'v': [v.days, v.seconds, v.microseconds]}
+    if isinstance(v, (bytes, memoryview)):
+        return {'$': 'bytes', 'v': base64.b64encode(v).decode('ascii')}
+    if isinstance(v, list):
+        return [cache_value(e) for e in v]
+    if isinstance(v, dict):
+        return {'$': 'dict', 'v': {k: cache_value(e) for (k, e) in v.items()}}
+    raise TypeError('A value of the type {0} cannot be cached.'.format(
+        type(v).__name__))
+
+
+cached_value_decoders = {
+    'float': float,
+    'decimal': decimal.Decimal,
+    'datetime': datetime.datetime.fromisoformat,
+    'date': datetime.date.fromisoformat,
+    'time': datetime.time.fromisoformat,
+    'timedelta': lambda v: datetime.timedelta(*v),
+    # psycopg2 returns bytea values as memoryview
+    'bytes': lambda v: memoryview(base64.b64decode(v)),
+    'dict': lambda v: {k: cached_value(e) for (k, e) in v.items()},
+}
+
+
+def cached_value(v):
+    """Decodes a value of a row, which was encoded by cache_value."""
+    if isinstance(v, dict):
+        return cached_value_decoders[v['$']](v['v'])
+    if isinstance(v, list):
+        return [cached_value(e) for e in v]
+    return v
+
+
+def load_cached_result(key):
+    """Loads a cached result, if it exists and is not expired.
+
+    A cached result is a dict with the mogrified query,
+    the columns as pairs of name and type name, the rows,
+    and the time of expiry.
+    The file is compressed JSON, with the other values in the first
+    line and one batch of rows per line.
+    """
+    filename = path.join(result_cache_dir, key)
+    try:
+        with open(filename, 'rb') as fh:
+            lines = zlib.decompress(fh.read()).decode('utf-8').split('\n')
+        entry = json.loads(lines[0])
+        entry['rows'] = [tuple([cached_value(v) for v in row])
+                         for line in lines[1:]
+                         for row in json.loads(line)]
+    except (OSError, ValueError, KeyError, TypeError, zlib.error):
+        return None
+    if entry['expires'] < time.time():
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        return None
+    # the modification time marks the last use for the eviction
+    try:
+        os.utime(filename)
+    except OSError:
+        pass
+    return entry
+
+
+def save_cached_result(key, entry, max_size):
+    header = {'expires': entry['expires'], 'query': entry['query'],
+              'columns': entry['columns']}
+    data = zlib.compress('\n'.join(
+        [json.dumps(header)] + entry['batches']).encode('utf-8'))
+    if len(data) > max_size:
+        return
+    filename = path.join(result_cache_dir, key)
+    tmp_filename = '{0}.{1}.tmp'.format(filename, os.getpid())
+    try:
+        # the results may be confidential
+        os.makedirs(result_cache_dir, mode=0o700, exist_ok=True)
+        fd = os.open(tmp_filename,
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp_filename, filename)
+        evict_cached_results(max_size)
+    except OSError:
+        # the cache is only an optimization
+        pass
+
+
+def evict_cached_results(max_size):
+    """Removes the least recently used results,
+    until the cache is not larger than max_size bytes."""
+    entries = []
+    for name in os.listdir(result_cache_dir):
+        if name.endswith('.tmp'):
+            continue
+        filename = path.join(result_cache_dir, name)
+        stat = os.stat(filename)
+        entries.append((stat.st_mtime, stat.st_size, filename))
+    entries.sort()
+    size = sum([e[1] for e in entries])
+    for (mtime, file_size, filename) in entries:
+        if size <= max_size:
+            break
+        os.remove(filename)
+        size -= file_size
+
+
+def recording_handlers(handlers, entry, mogrify, max_size):
+    """Builds a handler set, which passes the result to the given
+    handlers and records it in the entry for the result cache,
+    as one line of JSON per batch of rows.
+
+    The recording stops, if the rows exceed max_size bytes
+    or contain a value, which cannot be cached.
+    """
+    rows_handler = rows_handler_of(handlers)
+    recorded = [0]
+
+    def query_handler(out, query):
+        entry['query'] = query
+        if mogrify:
+            handlers['query_handler'](out, query)
+
+    def columns_handler(cache, columns):
+        entry['columns'] = [(c.name, c.type) for c in columns]
+        entry['batches'] = []
+        handlers['columns_handler'](cache, columns)
+
+    def record_rows_handler(cache, rows):
+        if entry['batches'] is not None:
+            try:
+                batch = json.dumps([[cache_value(v) for v in row]
+                                    for row in rows])
+            except TypeError:
+                batch = None
+            if batch is not None:
+                recorded[0] += len(batch)
+            if batch is None or recorded[0] > max_size:
+                entry['batches'] = None
+            else:
+                entry['batches'].append(batch)
+        rows_handler(cache, rows)
+
+    return {
+        'info_handler': handlers['info_handler'],
+        'query_handler': query_handler,
+        'columns_handler': columns_handler,
+        'rows_handler': record_rows_handler,
+        'finalizer': handlers['finalizer']
+    }
+
+
+def write_cached_result(host, dbname, handlers, entry, **nargs):
+    out = nargs['out']
+    if nargs.get('info'):
+        handlers['info_handler'](out, [
+                ('server', host),
+                ('database', dbname),
+            ])
+    if nargs.get('mogrify'):
+        handlers['query_handler'](out, entry['query'])
+    cache = {'out': out, 'table_sample': nargs.get('table_sample', 1000)}
+    handlers['columns_handler'](
+        cache, [Column(name, type_name)
+                for (name, type_name) in entry['columns']])
+    rows_handler = rows_handler_of(handlers)
+    batch_size = nargs.get('batch_size', 2000)
+    rows = entry['rows']
+    for i in range(0, len(rows), batch_size):
+        rows_handler(cache, rows[i:i + batch_size])
+    handlers['finalizer'](cache)
+
+
+def run_cached_query(host, dbname, user, password, ssl,
+                     handlers, query, query_params, **nargs):
+    """Writes the result of a query from the result cache,
+    or runs the query and caches its result for cache_ttl seconds."""
+    key = result_cache_key(host, dbname, user, query, query_params)
+    entry = load_cached_result(key)
+    if entry is not None:
+        profile = nargs.get('profile')
+        profiled(profile, 'format', lambda: write_cached_result(
+            host, dbname, handlers, entry, **nargs))
+        if profile is not None:
+            profile['rows'] = len(entry['rows'])
+        return
+
+    max_size = nargs['cache_size']
+    entry = {'expires': time.time() + nargs['cache_ttl'], 'batches': None}
+    recorder = recording_handlers(
+        handlers, entry, nargs.get('mogrify'), max_size)
+    query_nargs = dict(nargs, mogrify=True)
+    del query_nargs['cache_ttl']
+    del query_nargs['cache_size']
+    run_query(host, dbname, user, password, ssl,
+              recorder, query, query_params, **query_nargs)
+    if entry['batches'] is not None:
+        save_cached_result(key, entry, max_size)
+
+
+def lookup_type_names(conn, oids):
+    type_cur = conn.cursor()
+    type_cur.execute(
+        """
+        SELECT oid, typname FROM pg_type
+        WHERE oid = ANY(%(oids)s::oid[])
+        """,
+        {'oids': list(oids)})
+    type_names = dict(type_cur.fetchall())
+    type_cur.close()
+    return type_names
+
+
+def process_result_format(conn, cur, type_cache=None):
+    """Builds the columns of a result.
+
+    The type names of all columns are looked up in one query,
+    known types are taken from the type cache,
+    which is a dict from the OID to a pair of type name and lookup time.
+    """
+    if type_cache is None:
+        type_cache = {}
+    missing = set(col.type_code for col in cur.description
+                  if col.type_code not in type_cache)
+    if missing:
+        now = time.time()
+        for (oid, type_name) in lookup_type_names(conn, missing).items():
+            type_cache[oid] = [type_name, now]
+
+    return [Column(col.name, type_cache[col.type_code][0])
+            for col in cur.description]
+
+
+def strip_sql(query):
+    """Removes comments, string literals and quoted identifiers
+    from a query, to inspect its structure.
+    The positions in the query are kept."""
+    return re.sub(
+        r"--[^\n]*|/\*.*?\*/|'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"",
+        lambda m: ' ' * len(m.group(0)), query, flags=re.DOTALL)
+
+
+def is_single_select(query):
+    """Checks if a query is a single statement, which returns rows
+    and can be used in a DECLARE CURSOR or a COPY statement.
+
+    SELECT INTO and data-modifying statements in a WITH clause
+    are not allowed there.
+    """
+    stripped = strip_sql(query).strip().rstrip(';').strip()
+    if ';' in stripped or '$' in stripped:
+        return False
+    if re.match(r'(SELECT|WITH|VALUES|TABLE)\b', stripped, re.I) is None:
+        return False
+    # the text outside of parentheses, for a top-level INTO
+    top_level = stripped
+    while True:
+        inner = re.sub(r'\([^()]*\)', ' ', top_level)
+        if inner == top_level:
+            break
+        top_level = inner
+    if re.search(r'\bINTO\b', top_level, re.I):
+        return False
+    locking = re.sub(r'\bFOR\s+(NO\s+KEY\s+)?UPDATE\b', ' ', stripped,
+                     flags=re.I)
+    return re.search(r'\b(INSERT|UPDATE|DELETE|MERGE)\b',
+                     locking, re.I) is None
+
+
+def rows_handler_of(handlers):
+    """Returns the handler for a batch of rows,
+    or adapts the handler for a single row."""
+    if 'rows_handler' in handlers:
+        return handlers['rows_handler']
+    row_handler = handlers['row_handler']
+
+    def rows_handler(cache, rows):
+        for row in rows:
+            row_handler(cache, row)
+
+    return rows_handler
+
+
+profile_phases = ['connect', 'explain', 'execute', 'first row',
+                  'type lookup', 'fetch', 'wait', 'format', 'finalize']
+
+
+def profiled(profile, phase, f, *args, **kwargs):
+    """Calls f and adds its duration to a phase of the profile,
+    a dict from the phase to the time in seconds."""
+    if profile is None:
+        return f(*args, **kwargs)
+    start = time.time()
+    try:
+        return f(*args, **kwargs)
+    finally:
+        profile[phase] = profile.get(phase, 0.0) + time.time() - start
+
+
+def iterate_rows(cur, cache, f, batch_size, rows=None, profile=None,
+                 pipeline=0):
+    if pipeline > 0:
+        iterate_rows_pipelined(cur, cache, f, batch_size, pipeline,
+                               rows, profile)
+        return
+    if rows is None:
+        rows = profiled(profile, 'first row', cur.fetchmany, batch_size)
+    while rows:
+        profiled(profile, 'format', f, cache, rows)
+        if profile is not None:
+            profile['rows'] = profile.get('rows', 0) + len(rows)
+        rows = profiled(profile, 'fetch', cur.fetchmany, batch_size)
+
+
+def put_unless_stopped(items, item, stop):
+    """Puts an item into a bounded queue, unless the consumer
+    stops before there is room for it. Returns False if it stopped."""
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def fetch_batches(cur, batch_size, batches, stop, profile):
+    """Fetches batches of rows into a queue, until the result
+    is exhausted, an error occurs, or the consumer stops.
+    The last batch is empty, an error is passed as the exception."""
+
+    def put(item):
+        return put_unless_stopped(batches, item, stop)
+
+    try:
+        while True:
+            rows = profiled(profile, 'fetch', cur.fetchmany, batch_size)
+            if not put(rows) or not rows:
+                return
+    except Exception as e:
+        put(e)
+
+
+def iterate_rows_pipelined(cur, cache, f, batch_size, depth,
+                           rows=None, profile=None):
+    """Like iterate_rows, but the next batches are fetched
+    in a separate thread, while the current batch is formatted.
+
+    At most depth batches are fetched ahead,
+    so the memory is bounded if the formatting is slower.
+    """
+    if rows is None:
+        rows = profiled(profile, 'first row', cur.fetchmany, batch_size)
+    if not rows:
+        return
+    batches = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    fetcher = threading.Thread(
+        target=fetch_batches,
+        args=(cur, batch_size, batches, stop, profile),
+        daemon=True)
+    fetcher.start()
+    try:
+        while rows:
+            profiled(profile, 'format', f, cache, rows)
+            if profile is not None:
+                profile['rows'] = profile.get('rows', 0) + len(rows)
+            # the time waiting for the fetcher is the part of the fetch,
+            # which does not overlap with the formatting
+            rows = profiled(profile, 'wait', batches.get)
+            if isinstance(rows, Exception):
+                raise rows
+    finally:
+        stop.set()
+        fetcher.join()
+
+
+def explain_query(conn, query, query_params):
+    """Runs a query with EXPLAIN (ANALYZE, BUFFERS)
+    and returns the lines of the plan.
+    The transaction is rolled back afterwards."""
+    cur = conn.cursor()
+    try:
+        cur.execute('EXPLAIN (ANALYZE, BUFFERS)\n' + strip_semicolons(query),
+                    query_params)
+        return [row[0] for row in cur.fetchall()]
+    finally:
+        cur.close()
+        conn.rollback()
+
+
+def write_profile(profile, f):
+    total = profile['total']
+    rows = profile.get('rows', 0)
+    print('Profile:', file=f)
+    for phase in profile_phases:
+        if phase in profile:
+            print('  {0:12} {1:9.3f} s {2:5.1f} %'.format(
+                      phase, profile[phase],
+                      100.0 * profile[phase] / total if total else 0.0),
+                  file=f)
+    print('  {0:12} {1:9.3f} s'.format('total', total), file=f)
+    print('  {0} rows, {1:.0f} rows/s, {2} bytes, {3:.2f} MB/s'.format(
+              rows, rows / total if total else 0.0,
+              profile['bytes'],
+              profile['bytes'] / total / 1e6 if total else 0.0),
+          file=f)
+    if 'plan' in profile:
+        print('', file=f)
+        for line in profile['plan']:
+            print(line, file=f)
+
+
+def strip_semicolons(query):
+    """Removes the semicolons of a single statement,
+    to embed it into another statement."""
+    stripped = strip_sql(query)
+    return ''.join([' ' if stripped[i] == ';' else c
+                    for (i, c) in enumerate(query)])
+
+
+def copy_result(cur, out, query, query_params, copy_options):
+    """Lets the server format the result of a single SELECT statement
+    with COPY TO STDOUT and streams it to the output."""
+    query = strip_semicolons(query)
+    copy = b'COPY (\n' + cur.mogrify(query, query_params) + \
+        b'\n) TO STDOUT WITH (' + copy_options.encode('ascii') + b')'
+    cur.copy_expert(copy, out)
+
+
+def read_sweep(f):
+    """Reads the query arguments for a sweep as a list of dicts,
+    from a CSV file with a header line
+    or from an NDJSON file with one object per line."""
+    lines = [line for line in f if line.strip()]
+    if lines and lines[0].lstrip().startswith('{'):
+        return [json.loads(line) for line in lines]
+    return list(csv.DictReader(lines))
+
+
+def sweep_column(name, value):
+    if isinstance(value, bool):
+        return Column(name, 'bool')
+    if isinstance(value, int):
+        return Column(name, 'int8')
+    if isinstance(value, float):
+        return Column(name, 'float8')
+    return Column(name, 'text')
+
+
+def execute_sweep(conn, handlers, query, query_params, **nargs):
+    """Prepares a query once and executes it for every set of
+    query arguments in nargs['sweep'].
+
+    The results are written as one result,
+    with the arguments of the query as the first columns.
+    """
+    out = nargs['out']
+    batch_size = nargs['batch_size']
+    names = []
+
+    def placeholder(m):
+        if m.group(0) == '%%':
+            return '%'
+        if m.group(1) not in names:
+            names.append(m.group(1))
+        return '${0}'.format(names.index(m.group(1)) + 1)
+
+    statement = re.sub(r'%\((\w+)\)s|%%', placeholder,
+                       strip_semicolons(query))
+    prepare = 'PREPARE pgquery_sweep AS\n' + statement.strip()
+    if names:
+        execute = 'EXECUTE pgquery_sweep ({0})'.format(
+            ', '.join(['%s'] * len(names)))
+    else:
+        execute = 'EXECUTE pgquery_sweep'
+
+    cur = conn.cursor()
+    if nargs['mogrify']:
+        handlers['query_handler'](out, prepare)
+    cur.execute(prepare)
+
+    rows_handler = rows_handler_of(handlers)
+    cache = None
+    for sweep_params in nargs['sweep']:
+        params = dict(query_params)
+        params.update(sweep_params)
+        values = tuple([params[name] for name in names])
+        profiled(nargs.get('profile'), 'execute', cur.execute, execute, values)
+        if cur.description is None:
+            continue
+        if cache is None:
+            columns = [sweep_column(name, value)
+                       for (name, value) in zip(names, values)] + \
+                profiled(nargs.get('profile'), 'type lookup',
+                         process_result_format,
+                         conn, cur, nargs.get('type_cache'))
+            cache = {'out': out, 'table_sample': nargs['table_sample']}
+            handlers['columns_handler'](cache, columns)
+        iterate_rows(cur, cache,
+                     lambda c, rows: rows_handler(
+                         c, [values + tuple(row) for row in rows]),
+                     batch_size, profile=nargs.get('profile'),
+                     pipeline=nargs.get('pipeline', 0))
+    if cache is not None:
+        handlers['finalizer'](cache)
+
+    cur.execute('DEALLOCATE pgquery_sweep')
+    cur.close()
+    conn.commit()
+
+
+def export_file_name(key):
+    """Builds a file name from the value of a key column."""
+    return re.sub(r'[^\w.-]', '_', str(key)).lstrip('.') or '_'
+
+
+def export_bytes(filename, value):
+    """Writes the value of a bytea column to a file.
+
+    psycopg2 returns a bytea value as a memoryview,
+    which is written without a copy or a conversion to text.
+    An existing file is never overwritten.
+    """
+    with open(filename, 'xb') as fh:
+        fh.write(value)
+
+
+def export_large_object(conn, oid, filename, chunk_size=1024 * 1024):
+    """Streams a large object to a file in chunks,
+    so it never is in the memory of the client as a whole.
+    An existing file is never overwritten."""
+    lo = conn.lobject(oid, 'rb')
+    try:
+        with open(filename, 'xb') as fh:
+            while True:
+                chunk = lo.read(chunk_size)
+                if not chunk:
+                    break
+                fh.write(chunk)
+    finally:
+        lo.close()
+
+
+def export_handlers(handlers, conn, export):
+    """Wraps a set of handlers, to write the bytea columns
+    and the large objects of every row to files.
+
+    The files are named after the key column and the values
+    are replaced by the file names before they are formatted.
+    """
+    rows_handler = rows_handler_of(handlers)
+    # the names of the files written in this run, different keys
+    # can have the same file name, after their characters are replaced
+    state = {'names': set()}
+
+    def columns_handler(cache, columns):
+        names = [c.name for c in columns]
+        for name in [export['key']] + export['large_objects']:
+            if name is not None and name not in names:
+                raise ValueError('The column {0} is not in the result.'
+                                 .format(name))
+        state['key'] = names.index(export['key'] or names[0])
+        state['columns'] = [
+            (i, c.name, c.type == 'bytea') for (i, c) in enumerate(columns)
+            if c.type == 'bytea' or c.name in export['large_objects']]
+        exported = [i for (i, name, is_bytea) in state['columns']]
+        handlers['columns_handler'](cache, [
+            Column(c.name, 'text') if i in exported else c
+            for (i, c) in enumerate(columns)])
+
+    def export_rows_handler(cache, rows):
+        exported_rows = []
+        for row in rows:
+            row = list(row)
+            key = row[state['key']]
+            if key is None:
+                raise ValueError('The key column of an exported row is NULL.')
+            name = export_file_name(key)
+            if name in state['names']:
+                raise ValueError(
+                    'The key {0} is not unique in the export, '.format(key) +
+                    'its file name {0} is already used.'.format(name))
+            state['names'].add(name)
+            base = path.join(export['dir'], name)
+            for (i, name, is_bytea) in state['columns']:
+                if row[i] is None:
+                    continue
+                filename = base if len(state['columns']) == 1 \
+                    else base + '.' + name
+                if is_bytea:
+                    export_bytes(filename, row[i])
+                else:
+                    export_large_object(conn, row[i], filename)
+                row[i] = filename
+            exported_rows.append(tuple(row))
+        rows_handler(cache, exported_rows)
+
+    res = dict(handlers)
+    res.pop('row_handler', None)
+    res.pop('copy_options', None)
+    res['columns_handler'] = columns_handler
+    res['rows_handler'] = export_rows_handler
+    return res
 
 
 def execute_query(conn, handlers,
@@ -118,20 +934,74 @@ def execute_query(conn, handlers,
 
     if 'mogrify' not in nargs:
         nargs['mogrify'] = False
-
-    cur = conn.cursor()
+    if 'batch_size' not in nargs:
+        nargs['batch_size'] = 2000
+    if 'copy' not in nargs:
+        nargs['copy'] = True
+    if 'out' not in nargs:
+        nargs['out'] = OutputWriter(stdout.buffer)
+    if 'table_sample' not in nargs:
+        nargs['table_sample'] = 1000
+    batch_size = nargs['batch_size']
+    out = nargs['out']
+    profile = nargs.get('profile')
+
+    if profile is not None and nargs.get('explain') and \
+            is_single_select(query):
+        profile['plan'] = profiled(
+            profile, 'explain', explain_query, conn, query, query_params)
+
+    if nargs.get('export') is not None:
+        handlers = export_handlers(handlers, conn, nargs['export'])
+
+    if nargs.get('sweep') is not None:
+        execute_sweep(conn, handlers, query, query_params, **nargs)
+        return
+
+    single_select = is_single_select(query)
+    # formats, which PostgreSQL can produce itself, are written by COPY
+    use_copy = single_select and nargs['copy'] and \
+        'copy_options' in handlers
+
+    # a named cursor is a server-side cursor, which sends the result
+    # in batches, instead of loading it into the memory of the client
+    if single_select and not use_copy:
+        cur = conn.cursor(name='pgquery')
+        cur.itersize = batch_size
+    else:
+        cur = conn.cursor()
 
     if nargs['mogrify']:
         m_query = cur.mogrify(query, query_params).strip()
-        handlers['query_handler'](m_query)
-
-    cur.execute(query, query_params)
+        handlers['query_handler'](out, m_query.decode(
+            psycopg2.extensions.encodings.get(conn.encoding, 'utf-8')))
+
+    if use_copy:
+        profiled(profile, 'execute', copy_result,
+                 cur, out, query, query_params, handlers['copy_options'])
+        if profile is not None and cur.rowcount >= 0:
+            profile['rows'] = cur.rowcount
+        cur.close()
+        conn.commit()
+        return
+
+    profiled(profile, 'execute', cur.execute, query, query_params)
+
+    # the description of a named cursor is only known
+    # after the first rows were fetched
+    if cur.name:
+        rows = profiled(profile, 'first row', cur.fetchmany, batch_size)
+    else:
+        rows = None
 
-    columns = process_result_format(conn, cur)
-    cache = {}
-    handlers['columns_handler'](cache, columns)
-    iterate_rows(cur, cache, handlers['row_handler'])
-    handlers['finalizer'](cache)
+    if cur.description is not None:
+        columns = profiled(profile, 'type lookup', process_result_format,
+                           conn, cur, nargs.get('type_cache'))
+        cache = {'out': out, 'table_sample': nargs['table_sample']}
+        handlers['columns_handler'](cache, columns)
+        iterate_rows(cur, cache, rows_handler_of(handlers), batch_size, rows,
+                     profile=profile, pipeline=nargs.get('pipeline', 0))
+        profiled(profile, 'finalize', handlers['finalizer'], cache)
 
     cur.close()
     conn.commit()
@@ -142,23 +1012,471 @@ def run_query(host, dbname, user, password, ssl,
 
     if 'info' not in nargs:
         nargs['info'] = False
+    if 'out' not in nargs:
+        nargs['out'] = OutputWriter(stdout.buffer)
 
     if nargs['info']:
-        handlers['info_handler']([
+        handlers['info_handler'](nargs['out'], [
                 ('server', host),
                 ('database', dbname),
             ])
 
-    conn = psycopg2.connect(
-        host=host,
-        dbname=dbname,
-        sslmode=('require' if ssl else 'allow'),
-        user=user,
-        password=password)
+    params = {
+        'host': host,
+        'dbname': dbname,
+        'sslmode': ('require' if ssl else 'allow'),
+        'user': user,
+        'password': password,
+    }
+    pool = nargs.get('pool')
+    conn = profiled(nargs.get('profile'), 'connect',
+                    pool.acquire if pool else psycopg2.connect, **params)
+
+    if nargs.get('type_cache', True):
+        cache_file = type_cache_file(host, dbname)
+        type_cache = load_type_cache(cache_file, conn.server_version)
+        cached_types = len(type_cache)
+        nargs['type_cache'] = type_cache
+    else:
+        nargs['type_cache'] = None
+
+    try:
+        execute_query(conn, handlers, query, query_params, **nargs)
+    except Exception:
+        conn.close()
+        raise
 
-    execute_query(conn, handlers, query, query_params, **nargs)
+    if nargs['type_cache'] is not None and \
+            len(nargs['type_cache']) > cached_types:
+        save_type_cache(cache_file, conn.server_version, nargs['type_cache'])
 
-    conn.close()
+    if pool:
+        pool.release(conn, **params)
+    else:
+        conn.close()
+
+
+def read_inventory(f):
+    """Reads the targets of an inventory file
+    as a list of pairs of host and database name.
+
+    Every line holds a host and a database name,
+    separated by whitespace. Empty lines and comments with # are skipped.
+    """
+    targets = []
+    for line in f:
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        if len(fields) != 2:
+            raise ValueError(
+                'Invalid line in inventory: {0}'.format(line.strip()))
+        targets.append((fields[0], fields[1]))
+    return targets
+
+
+class Stopped(Exception):
+    """Raised in a handler, when the consumer of the result stopped."""
+    pass
+
+
+def relay_handlers(target, results, stop):
+    """Builds a handler set, which passes the result of a target
+    to the queue of the fan-out.
+
+    The query is aborted, if the consumer sets the event stop.
+    """
+
+    def put(message):
+        if not put_unless_stopped(results, message, stop):
+            raise Stopped()
+
+    def query_handler(out, query):
+        put(('query', target, query))
+
+    def columns_handler(cache, columns):
+        put(('columns', target, columns))
+
+    def rows_handler(cache, rows):
+        put(('rows', target, rows))
+
+    return {
+        'info_handler': lambda out, info: None,
+        'query_handler': query_handler,
+        'columns_handler': columns_handler,
+        'rows_handler': rows_handler,
+        'finalizer': lambda cache: None
+    }
+
+
+def run_fan_out(targets, user, password, ssl,
+                handlers, query, query_params, **nargs):
+    """Runs a query against a number of targets over a bounded pool
+    of connections and writes the results through one handler set,
+    with an additional column source.
+
+    The time and the row count or the error of every target
+    are reported on stderr. Returns the number of failed targets.
+    """
+
+    if 'parallel' not in nargs:
+        nargs['parallel'] = 8
+    if 'out' not in nargs:
+        nargs['out'] = OutputWriter(stdout.buffer)
+    if 'err' not in nargs:
+        nargs['err'] = stderr
+    out = nargs['out']
+
+    if nargs.get('info'):
+        handlers['info_handler'](out, [
+            ('target', '{0}/{1}'.format(host, dbname))
+            for (host, dbname) in targets])
+
+    work = queue.Queue()
+    for target in targets:
+        work.put(target)
+    # the bounded queue blocks the workers, if the output falls behind
+    results = queue.Queue(maxsize=4 * nargs['parallel'])
+    # the workers stop, if the output fails
+    stop = threading.Event()
+    worker_nargs = dict(nargs, info=False, out=None)
+    del worker_nargs['parallel']
+    del worker_nargs['err']
+
+    def worker():
+        while not stop.is_set():
+            try:
+                target = work.get_nowait()
+            except queue.Empty:
+                break
+            start = time.time()
+            try:
+                run_query(target[0], target[1], user, password, ssl,
+                          relay_handlers(target, results, stop),
+                          query, query_params, **worker_nargs)
+                put_unless_stopped(
+                    results, ('done', target, time.time() - start), stop)
+            except Exception as e:
+                put_unless_stopped(
+                    results, ('error', target, (time.time() - start, e)),
+                    stop)
+
+    for i in range(min(nargs['parallel'], len(targets))):
+        threading.Thread(target=worker, daemon=True).start()
+    try:
+        return write_fan_out(targets, handlers, results, **nargs)
+    finally:
+        stop.set()
+
+
+def write_fan_out(targets, handlers, results, **nargs):
+    """Writes the results of the fan-out from the queue
+    of the workers. Returns the number of failed targets."""
+    out = nargs['out']
+    err = nargs['err']
+
+    columns = None
+    cache = {'out': out, 'table_sample': nargs.get('table_sample', 1000)}
+    rows_handler = rows_handler_of(handlers)
+    row_counts = {}
+    rejected = set()
+    failed = 0
+    finished = 0
+    query_printed = False
+    while finished < len(targets):
+        (kind, target, data) = results.get()
+        source = '{0}/{1}'.format(*target)
+        if kind == 'query':
+            if not query_printed:
+                handlers['query_handler'](out, data)
+                query_printed = True
+        elif kind == 'columns':
+            if columns is None:
+                columns = data
+                handlers['columns_handler'](
+                    cache, [Column('source', 'text')] + columns)
+            elif [(c.name, c.type) for c in data] != \
+                    [(c.name, c.type) for c in columns]:
+                rejected.add(target)
+        elif kind == 'rows':
+            if target not in rejected:
+                rows_handler(cache, [(source,) + tuple(row) for row in data])
+                row_counts[target] = row_counts.get(target, 0) + len(data)
+        elif kind == 'done':
+            finished += 1
+            if target in rejected:
+                failed += 1
+                print('{0}: failed after {1:.2f} s: '.format(source, data) +
+                      'the columns differ from the first result',
+                      file=err)
+            else:
+                print('{0}: {1} rows in {2:.2f} s'.format(
+                          source, row_counts.get(target, 0), data),
+                      file=err)
+        else:
+            finished += 1
+            failed += 1
+            print('{0}: failed after {1:.2f} s: {2}'.format(
+                      source, data[0], str(data[1]).strip()),
+                  file=err)
+
+    if columns is not None:
+        handlers['finalizer'](cache)
+    return failed
+
+
+def stream_result(host, dbname, user, password, ssl,
+                  query, query_params, **nargs):
+    """Runs a query in a separate thread,
+    until the result is read or the event in nargs['stop'] is set.
+
+    Returns the columns of the result and an iterator over its rows.
+    The rows are passed through a bounded queue.
+    """
+    target = (host, dbname)
+    results = queue.Queue(maxsize=8)
+    stop = nargs.pop('stop')
+
+    def worker():
+        try:
+            run_query(host, dbname, user, password, ssl,
+                      relay_handlers(target, results, stop),
+                      query, query_params, **nargs)
+            put_unless_stopped(results, ('done', target, None), stop)
+        except Exception as e:
+            put_unless_stopped(results, ('error', target, e), stop)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    def next_message():
+        (kind, target, data) = results.get()
+        if kind == 'error':
+            raise data
+        return (kind, data)
+
+    (kind, data) = next_message()
+    while kind == 'query':
+        (kind, data) = next_message()
+    if kind != 'columns':
+        return (None, iter([]))
+
+    def rows():
+        while True:
+            (kind, batch) = next_message()
+            if kind != 'rows':
+                return
+            for row in batch:
+                yield row
+
+    return (data, rows())
+
+
+def row_digest(row):
+    # psycopg2 returns bytea values as memoryview
+    row = tuple([bytes(v) if isinstance(v, memoryview) else v for v in row])
+    return hashlib.blake2b(repr(row).encode('utf-8'), digest_size=16).digest()
+
+
+def compare_rows(rows1, rows2, key_of, chunk_rows):
+    """Compares two results, which are ordered by their key.
+
+    The first result is read in chunks of chunk_rows rows, the second one
+    up to the last key of the chunk. Only chunks with different hashes
+    are compared row by row. If the second result has more than
+    chunk_rows rows up to the last key, the chunk is compared row by row,
+    while the second result is read.
+    Yields pairs of the kind of difference and the key:
+    'changed', 'only in 1', 'only in 2', or 'equal' for matching rows,
+    which separate the differences.
+    """
+    rows1 = iter(rows1)
+    rows2 = iter(rows2)
+    pending = []
+    exhausted = False
+
+    def next_row2():
+        nonlocal exhausted
+        if not pending and not exhausted:
+            try:
+                pending.append(next(rows2))
+            except StopIteration:
+                exhausted = True
+        return pending[0] if pending else None
+
+    def rows2_up_to(chunk2, last):
+        for row in chunk2:
+            yield row
+        while next_row2() is not None and key_of(pending[0]) <= last:
+            yield pending.pop()
+
+    while True:
+        chunk1 = []
+        for row in rows1:
+            chunk1.append(row)
+            if len(chunk1) >= chunk_rows:
+                break
+        if chunk1:
+            last = key_of(chunk1[-1])
+        chunk2 = []
+        overflow = False
+        while next_row2() is not None:
+            if chunk1 and key_of(pending[0]) > last:
+                break
+            if len(chunk2) >= chunk_rows:
+                overflow = bool(chunk1)
+                break
+            chunk2.append(pending.pop())
+        if not chunk1 and not chunk2:
+            return
+        if overflow:
+            yield from merge_rows(chunk1, rows2_up_to(chunk2, last), key_of)
+            continue
+        digests1 = [row_digest(row) for row in chunk1]
+        digests2 = [row_digest(row) for row in chunk2]
+        if hashlib.blake2b(b''.join(digests1)).digest() == \
+                hashlib.blake2b(b''.join(digests2)).digest():
+            yield ('equal', None)
+            continue
+        yield from merge_rows(chunk1, chunk2, key_of)
+
+
+def merge_rows(rows1, rows2, key_of):
+    """Compares two ordered sequences of rows row by row."""
+    rows1 = iter(rows1)
+    rows2 = iter(rows2)
+    row1 = next(rows1, None)
+    row2 = next(rows2, None)
+    while row1 is not None or row2 is not None:
+        if row2 is None or (row1 is not None and key_of(row1) < key_of(row2)):
+            yield ('only in 1', key_of(row1))
+            row1 = next(rows1, None)
+        elif row1 is None or key_of(row2) < key_of(row1):
+            yield ('only in 2', key_of(row2))
+            row2 = next(rows2, None)
+        else:
+            if row_digest(row1) != row_digest(row2):
+                yield ('changed', key_of(row1))
+            else:
+                yield ('equal', key_of(row1))
+            row1 = next(rows1, None)
+            row2 = next(rows2, None)
+
+
+def difference_ranges(differences):
+    """Merges consecutive differences of the same kind into ranges
+    of (kind, first key, last key, number of rows)."""
+    current = None
+    for (kind, key) in differences:
+        if current and current[0] == kind:
+            current[2] = key
+            current[3] += 1
+            continue
+        if current:
+            yield tuple(current)
+            current = None
+        if kind != 'equal':
+            current = [kind, key, key, 1]
+    if current:
+        yield tuple(current)
+
+
+def run_compare(host, dbname, host2, dbname2, user, password, ssl,
+                handlers, query, query_params, **nargs):
+    """Runs a query against two targets at the same time
+    and writes the ranges of keys with differing rows.
+
+    Returns the number of differing rows.
+    """
+    # the queries are stopped, if the comparison ends early
+    stop = threading.Event()
+    try:
+        return compare_targets(host, dbname, host2, dbname2,
+                               user, password, ssl,
+                               handlers, query, query_params,
+                               stop=stop, **nargs)
+    finally:
+        stop.set()
+
+
+def compare_targets(host, dbname, host2, dbname2, user, password, ssl,
+                    handlers, query, query_params, **nargs):
+    out = nargs['out']
+    err = nargs['err']
+    key_names = nargs['key']
+    chunk_rows = nargs['chunk_rows']
+    query_nargs = dict(nargs)
+    for name in ['out', 'err', 'key', 'chunk_rows']:
+        del query_nargs[name]
+
+    (columns1, rows1) = stream_result(host, dbname, user, password, ssl,
+                                      query, query_params, **query_nargs)
+    (columns2, rows2) = stream_result(host2, dbname2, user, password, ssl,
+                                      query, query_params, **query_nargs)
+    if columns1 is None or columns2 is None:
+        raise ValueError('The query returns no result.')
+    if [c.name for c in columns1] != [c.name for c in columns2]:
+        raise ValueError('The results have different columns.')
+    names = [c.name for c in columns1]
+    for name in key_names or []:
+        if name not in names:
+            raise ValueError('The key column {0} is not in the result.'
+                             .format(name))
+    indices = [names.index(name) for name in key_names or names[:1]]
+    # NULL cannot be compared with the other keys
+    null_key = 'A key column is NULL. ' + \
+        'Leave the rows with NULL keys out of the query for a comparison.'
+    if len(indices) == 1:
+        index = indices[0]
+
+        def key_of(row):
+            if row[index] is None:
+                raise ValueError(null_key)
+            return row[index]
+
+        key_text = str
+    else:
+        def key_of(row):
+            key = tuple([row[i] for i in indices])
+            if any([v is None for v in key]):
+                raise ValueError(null_key)
+            return key
+
+        key_text = lambda key: ', '.join(map(str, key))
+
+    counts = [0, 0]
+
+    def counted(rows, i):
+        for row in rows:
+            counts[i] += 1
+            yield row
+
+    cache = {'out': out, 'table_sample': nargs.get('table_sample', 1000)}
+    handlers['columns_handler'](cache, [
+        Column('difference', 'text'),
+        Column('first_key', 'text'),
+        Column('last_key', 'text'),
+        Column('rows', 'int8')])
+    rows_handler = rows_handler_of(handlers)
+    differences = 0
+    ranges = 0
+    batch = []
+    for (kind, first, last, rows) in difference_ranges(compare_rows(
+            counted(rows1, 0), counted(rows2, 1), key_of, chunk_rows)):
+        batch.append((kind, key_text(first), key_text(last), rows))
+        differences += rows
+        ranges += 1
+        if len(batch) >= 100:
+            rows_handler(cache, batch)
+            batch = []
+    if batch:
+        rows_handler(cache, batch)
+    handlers['finalizer'](cache)
+
+    print('1: {0}/{1}: {2} rows'.format(host, dbname, counts[0]), file=err)
+    print('2: {0}/{1}: {2} rows'.format(host2, dbname2, counts[1]), file=err)
+    print('{0} differing rows in {1} ranges'.format(differences, ranges),
+          file=err)
+    return differences
 
 
 def make_unique(columns):
@@ -192,95 +1510,279 @@ def is_numeric_type(type_name):
         type_name == 'float8'
 
 
-def table_info_handler(info):
+def table_info_handler(out, info):
     for (k, v) in info:
-        print('{0}: {1}'.format(k, v))
-    print('')
+        out.line('{0}: {1}'.format(k, v))
+    out.line()
+
+
+def table_query_handler(out, query):
+    out.line(query)
+    out.line()
+
+
+def table_cell_text(v):
+    if isinstance(v, float):
+        return '{0:.3f}'.format(v)
+    return str(v)
+
+
+def display_width(text):
+    """The number of terminal cells of a text,
+    wide East Asian characters take two cells, combining characters none."""
+    if text.isascii():
+        return len(text)
+    return sum([0 if unicodedata.combining(c) else
+                2 if unicodedata.east_asian_width(c) in 'WF' else 1
+                for c in text])
+
+
+def split_display(line, width):
+    """Splits a line into parts of at most width terminal cells."""
+    if line.isascii():
+        return [line[i:i + width] for i in range(0, len(line), width)]
+    parts = []
+    part = ''
+    part_width = 0
+    for c in line:
+        w = display_width(c)
+        if part and part_width + w > width:
+            parts.append(part)
+            part = ''
+            part_width = 0
+        part += c
+        part_width += w
+    parts.append(part)
+    return parts
+
+
+def table_rule(widths):
+    return '+' + '+'.join(['-' * w for w in widths]) + '+\n'
+
+
+def table_row_text(cells, widths, aligns):
+    """Renders the lines of a table row.
+
+    Lines, which are longer than the width of their column, are split
+    at the width. Right-aligned and centred cells (numbers and booleans)
+    are never split, they overflow their column instead.
+    """
+    if all([display_width(text) <= width and '\n' not in text
+            for (text, width) in zip(cells, widths)]):
+        return '|' + '|'.join([
+            justify(text, width, align)
+            for (text, width, align) in zip(cells, widths, aligns)]) + '|\n'
+    cell_lines = []
+    for (text, width, align) in zip(cells, widths, aligns):
+        lines = []
+        for line in text.split('\n'):
+            if align == 'l' and display_width(line) > width:
+                lines.extend(split_display(line, width))
+            else:
+                lines.append(line)
+        cell_lines.append(lines)
+    height = max([len(lines) for lines in cell_lines] + [1])
+    text = ''
+    for y in range(height):
+        text += '|' + '|'.join([
+            justify(lines[y] if y < len(lines) else '', width, align)
+            for (lines, width, align) in zip(cell_lines, widths, aligns)
+        ]) + '|\n'
+    return text
 
 
-def table_query_handler(query):
-    print(query)
-    print('')
+def justify(text, width, align):
+    # str.center needs the padding in characters, not in terminal cells
+    padding = width - display_width(text)
+    width = len(text) + max(0, padding)
+    if align == 'r':
+        return text.rjust(width)
+    if align == 'c':
+        return text.center(width)
+    return text.ljust(width)
 
 
 def table_columns_handler(cache, columns):
     columns = make_unique(columns)
-    table = prettytable.PrettyTable(map(lambda c: c.name, columns))
-    cache['table'] = table
-    table.padding_width = 0
-    table.border = True
-    table.vrules = prettytable.ALL
-    table.valign = 't'
-    # table.int_format = '8'
-    table.float_format = '0.3'
+    cache['names'] = [c.name for c in columns]
+    aligns = []
     for c in columns:
         if is_numeric_type(c.type):
-            table.align[c.name] = 'r'
+            aligns.append('r')
         elif c.type == 'bool':
-            table.align[c.name] = 'c'
+            aligns.append('c')
         else:
-            table.align[c.name] = 'l'
-
-
-def table_row_handler(cache, row):
-    table = cache['table']
-    table.add_row(row)
+            aligns.append('l')
+    cache['aligns'] = aligns
+    cache['sample'] = []
+    cache['widths'] = None
+
+
+def table_start(cache):
+    """Takes the column widths from the sampled rows
+    and writes the header and the sampled rows."""
+    names = cache['names']
+    sample = cache['sample']
+    widths = [max([display_width(line)
+                   for text in [name] + [cells[i] for cells in sample]
+                   for line in text.split('\n')])
+              for (i, name) in enumerate(names)]
+    aligns = cache['aligns']
+    rule = table_rule(widths)
+    cache['widths'] = widths
+    cache['out'].text(
+        rule + table_row_text(names, widths, aligns) + rule +
+        ''.join([table_row_text(cells, widths, aligns) for cells in sample]))
+    cache['sample'] = None
+    # the first rows are shown right away, not after the output buffer is full
+    cache['out'].flush()
+
+
+def table_rows_handler(cache, rows):
+    # the rows are rendered progressively, the widths of the columns
+    # are taken from the first rows of the result
+    if cache['widths'] is None:
+        cache['sample'].extend([list(map(table_cell_text, row))
+                                for row in rows])
+        if len(cache['sample']) >= cache['table_sample']:
+            table_start(cache)
+        return
+    widths = cache['widths']
+    aligns = cache['aligns']
+    cache['out'].text(''.join([
+        table_row_text(list(map(table_cell_text, row)), widths, aligns)
+        for row in rows]))
 
 
 def table_finalizer(cache):
-    table = cache['table']
-    print(table)
+    if cache['widths'] is None:
+        table_start(cache)
+    cache['out'].text(table_rule(cache['widths']))
 
 
 table_handlers = {
         'info_handler': table_info_handler,
         'query_handler': table_query_handler,
         'columns_handler': table_columns_handler,
-        'row_handler': table_row_handler,
+        'rows_handler': table_rows_handler,
         'finalizer': table_finalizer
     }
 
 
-def escape_csv_value(v, type_name):
-    v = str(v)
-    if '"' in v:
-        v = v.replace('"', '""')
-    if '"' in v or ',' in v or \
-       type_name == 'text':
+def copy_float_text(v):
+    if math.isnan(v):
+        return 'NaN'
+    if math.isinf(v):
+        return 'Infinity' if v > 0 else '-Infinity'
+    return str(v)
+
+
+def copy_interval_text(v):
+    """Writes a timedelta like an interval in the IntervalStyle postgres,
+    e.g. 1 day 02:00:00 or -3 days -00:00:01.5."""
+    total = (v.days * 86400 + v.seconds) * 1000000 + v.microseconds
+    sign = '-' if total < 0 else ''
+    (days, rest) = divmod(abs(total), 86400 * 1000000)
+    (seconds, microseconds) = divmod(rest, 1000000)
+    parts = []
+    if days:
+        parts.append('{0}{1} {2}'.format(
+            sign, days, 'day' if days == 1 and not sign else 'days'))
+    if rest or not days:
+        time_text = '{0}{1:02d}:{2:02d}:{3:02d}'.format(
+            sign, seconds // 3600, seconds // 60 % 60, seconds % 60)
+        if microseconds:
+            time_text += '.{0:06d}'.format(microseconds).rstrip('0')
+        parts.append(time_text)
+    return ' '.join(parts)
+
+
+def copy_text(type_name):
+    """Builds the function for the text of a value of a column,
+    as PostgreSQL writes it with COPY."""
+    if type_name == 'bool':
+        return lambda v: 't' if v else 'f'
+    if type_name == 'bytea':
+        return lambda v: '\\x' + bytes(v).hex()
+    if type_name in ['float4', 'float8']:
+        return copy_float_text
+    if type_name in ['json', 'jsonb']:
+        return lambda v: v if isinstance(v, str) else \
+            json.dumps(v, ensure_ascii=False)
+    if type_name == 'interval':
+        return copy_interval_text
+    if type_name in ['timestamptz', 'timetz']:
+        # PostgreSQL writes a time zone offset of full hours as +HH
+        return lambda v: re.sub(r'([+-]\d\d):00$', r'\1', str(v))
+    if type_name.startswith('_'):
+        return copy_array_text(copy_text(type_name[1:]))
+    return str
+
+
+def copy_array_text(element_text):
+    def array_text(v):
+        if not isinstance(v, list):
+            return element_text(v)
+        return '{' + ','.join([element(e) for e in v]) + '}'
+
+    def element(e):
+        if e is None:
+            return 'NULL'
+        if isinstance(e, list):
+            return array_text(e)
+        text = element_text(e)
+        if text == '' or text.upper() == 'NULL' or \
+                re.search(r'[{},"\\\s]', text):
+            return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        return text
+
+    return array_text
+
+
+def csv_field(text, delimiter):
+    if text == '' or delimiter in text or '"' in text or \
+            '\n' in text or '\r' in text:
+        return '"' + text.replace('"', '""') + '"'
+    return text
 
-        v = '"{0}"'.format(v)
 
-    return v
+def csv_formatter(type_name, delimiter=','):
+    """Builds the function for the CSV field of a value of a column,
+    in the same dialect as COPY with FORMAT csv:
+    NULL is an empty field, an empty text is quoted
+    and other values are only quoted if necessary."""
+    text = copy_text(type_name)
+    if is_numeric_type(type_name) or type_name == 'bool':
+        return lambda v: '' if v is None else text(v)
+    return lambda v: '' if v is None else csv_field(text(v), delimiter)
 
 
-def csv_info_handler(info):
+def csv_info_handler(out, info):
     for (k, v) in info:
-        print('# {0}: {1}'.format(k, v))
-    print('')
+        out.line('# {0}: {1}'.format(k, v))
+    out.line()
 
 
-def csv_query_handler(query):
+def csv_query_handler(out, query):
     line_start_p = re.compile(r'^', re.MULTILINE)
     query = line_start_p.sub('# ', query)
-    print(query)
-    print('')
-
-
-def csv_columns_handler(cache, columns):
-    cache['columns'] = columns
-    print(', '.join(map(
-        lambda c: escape_csv_value(c.name, 'text'),
-        columns)))
+    out.line(query)
+    out.line()
 
 
-def csv_row_handler(cache, row):
-    columns = cache['columns']
+def csv_columns_handler(cache, columns, delimiter=','):
+    cache['delimiter'] = delimiter
+    cache['formatters'] = [csv_formatter(c.type, delimiter) for c in columns]
+    cache['out'].line(delimiter.join([
+        csv_field(c.name, delimiter) for c in columns]))
 
-    def format_value(v, i):
-        return escape_csv_value(v, columns[i].type)
 
-    formatted_row = map(format_value, row, range(len(row)))
-    print(', '.join(formatted_row))
+def csv_rows_handler(cache, rows):
+    formatters = cache['formatters']
+    delimiter = cache['delimiter']
+    cache['out'].text(''.join([
+        delimiter.join([f(v) for (f, v) in zip(formatters, row)]) + '\n'
+        for row in rows]))
 
 
 def csv_finalizer(cache):
@@ -291,38 +1793,27 @@ csv_handlers = {
         'info_handler': csv_info_handler,
         'query_handler': csv_query_handler,
         'columns_handler': csv_columns_handler,
-        'row_handler': csv_row_handler,
-        'finalizer': csv_finalizer
+        'rows_handler': csv_rows_handler,
+        'finalizer': csv_finalizer,
+        'copy_options': 'FORMAT csv, HEADER'
     }
 
 
-def escape_tsv_value(v):
-    v = str(v)
-    v = v.replace("\t", ' ')
-    return v
-
-
-def tsv_info_handler(info):
+def tsv_info_handler(out, info):
     for (k, v) in info:
-        print('# {0}: {1}'.format(k, v))
-    print('')
+        out.line('# {0}: {1}'.format(k, v))
+    out.line()
 
 
-def tsv_query_handler(query):
+def tsv_query_handler(out, query):
     line_start_p = re.compile(r'^', re.MULTILINE)
     query = line_start_p.sub('# ', query)
-    print(query)
-    print('')
+    out.line(query)
+    out.line()
 
 
 def tsv_columns_handler(cache, columns):
-    print("\t".join(map(
-        lambda c: escape_tsv_value(c.name),
-        columns)))
-
-
-def tsv_row_handler(cache, row):
-    print("\t".join(map(escape_tsv_value, row)))
+    csv_columns_handler(cache, columns, "\t")
 
 
 def tsv_finalizer(cache):
@@ -333,64 +1824,71 @@ tsv_handlers = {
         'info_handler': tsv_info_handler,
         'query_handler': tsv_query_handler,
         'columns_handler': tsv_columns_handler,
-        'row_handler': tsv_row_handler,
-        'finalizer': tsv_finalizer
+        'rows_handler': csv_rows_handler,
+        'finalizer': tsv_finalizer,
+        'copy_options': "FORMAT csv, DELIMITER E'\\t', HEADER"
     }
 
 
-def html_info_handler(info):
-    print('<ul>')
+def html_info_handler(out, info):
+    out.line('<ul>')
     for (k, v) in info:
-        print('  <li>{0}: {1}</li>'.format(k, v))
-    print('</ul>')
-
-
-def html_query_handler(query):
-    print('<pre><code class="sql-query">')
-    print(query)
-    print('</code></pre>')
-    print('')
+        out.line('  <li>{0}: {1}</li>'.format(k, v))
+    out.line('</ul>')
+
+
+def html_query_handler(out, query):
+    out.line('<pre><code class="sql-query">')
+    out.line(query)
+    out.line('</code></pre>')
+    out.line()
+
+
+def html_formatter(type_name):
+    """Builds the function for the table cell of a column."""
+    css_class = None
+    if is_numeric_type(type_name):
+        css_class = 'number'
+    elif type_name == 'bool':
+        css_class = 'bool'
+    elif type_name == 'timestamp':
+        css_class = 'timestamp'
+    if css_class:
+        start = '    <td class="' + css_class + '">'
+    else:
+        start = '    <td>'
+    return lambda v: start + str(v) + '</td>\n'
 
 
 def html_columns_handler(cache, columns):
     columns = make_unique(columns)
-    cache['columns'] = columns
-    print('<table>')
-    print('  <thead><tr>')
+    cache['formatters'] = [html_formatter(c.type) for c in columns]
+    out = cache['out']
+    out.line('<table>')
+    out.line('  <thead><tr>')
     for c in columns:
-        print('    <td>' + c.name + '</td>')
-    print('  </tr></thead>')
+        out.line('    <td>' + c.name + '</td>')
+    out.line('  </tr></thead>')
 
 
-def html_row_handler(cache, row):
-    columns = cache['columns']
-    print('<tr>')
-    for i in range(len(columns)):
-        c = columns[i]
-        v = str(row[i])
-        css_class = None
-        if is_numeric_type(c.type):
-            css_class = 'number'
-        elif c.type == 'bool':
-            css_class = 'bool'
-        elif c.type == 'timestamp':
-            css_class = 'timestamp'
-        if css_class:
-            print('    <td class="' + css_class + '">' + v + '</td>')
-        else:
-            print('    <td>' + v + '</td>')
-    print('  </tr>')
+def html_rows_handler(cache, rows):
+    formatters = cache['formatters']
+    cache['out'].text(''.join([
+        '<tr>\n' +
+        ''.join([f(v) for (f, v) in zip(formatters, row)]) +
+        '  </tr>\n'
+        for row in rows]))
 
 
 def html_finalizer(cache):
-    print('</table>')
+    cache['out'].line('</table>')
 
 
 html_handlers = {
         'info_handler': html_info_handler,
         'query_handler': html_query_handler,
         'columns_handler': html_columns_handler,
-        'row_handler': html_row_handler,
+        'rows_handler': html_rows_handler,
         'finalizer': html_finalizer
     }
 
@@ -403,19 +1901,26 @@ def escape_md_text(text):
     return text
 
 
-def md_info_handler(info):
+def escape_md_cell_value(v):
+    v = escape_md_text(v)
+    v = v.replace('|', '&#448;')
+    v = v.replace('\n', '<br>')
+    return v
+
+
+def md_info_handler(out, info):
     for (k, v) in info:
-        print('* **{0}**: `{1}`'.format(
+        out.line('* **{0}**: `{1}`'.format(
             escape_md_text(k),
             escape_md_text(v)))
-    print('')
+    out.line()
 
 
-def md_query_handler(query):
-    print('~~~')
-    print(query)
-    print('~~~')
-    print('')
+def md_query_handler(out, query):
+    out.line('~~~')
+    out.line(query)
+    out.line('~~~')
+    out.line()
 
 
 def md_table_columns_handler(cache, columns):
@@ -427,23 +1932,19 @@ def md_table_columns_handler(cache, columns):
             return ':' + ('-' * l) + ':'
         return ':' + ('-' * (l + 1))
 
-    print('| {0} |'.format(
+    out = cache['out']
+    out.line('| {0} |'.format(
         ' | '.join(map(
             lambda c: c.name,
             columns))))
-    print('|{0}|'.format(
+    out.line('|{0}|'.format(
         '|'.join(map(align_str, columns))))
 
 
-def md_table_row_handler(cache, row):
-    def escape_cell_value(v):
-        v = str(v)
-        v = escape_md_text(v)
-        v = v.replace('|', '&#448;')
-        v = v.replace('\n', '<br>')
-        return v
-    print('|{0}|'.format(
-        '|'.join(map(escape_cell_value, row))))
+def md_table_rows_handler(cache, rows):
+    cache['out'].text(''.join([
+        '|' + '|'.join(map(escape_md_cell_value, row)) + '|\n'
+        for row in rows]))
 
 
 def md_finalizer(cache):
@@ -454,54 +1955,205 @@ md_table_handlers = {
         'info_handler': md_info_handler,
         'query_handler': md_query_handler,
         'columns_handler': md_table_columns_handler,
-        'row_handler': md_table_row_handler,
+        'rows_handler': md_table_rows_handler,
         'finalizer': md_finalizer
     }
 
 
+def md_list_formatter(column):
+    """Builds the function for the list item of a column."""
+    name = escape_md_text(column.name)
+    start = '    + __' + name + '__: '
+    block_start = '    + __' + name + '__:\n\n~~~\n'
+
+    def format_value(v):
+        v = str(v)
+        if '\n' in v:
+            return block_start + v + '\n~~~\n\n'
+        return start + escape_md_text(v) + '\n'
+
+    return format_value
+
+
 def md_list_columns_handler(cache, columns):
-    cache['columns'] = columns
-
-
-def md_list_row_handler(cache, row):
-    columns = cache['columns']
-    if len(row) > 0:
-        print('* **{0}**'.format(escape_md_text(row[0])))
-    for i in range(len(row)):
-        name = escape_md_text(columns[i].name)
-        value = str(row[i])
-        if "\n" in value:
-            print('    + __{0}__:'.format(name))
-            print('')
-            print('~~~')
-            print(value)
-            print('~~~')
-            print('')
-        else:
-            value = escape_md_text(value)
-            print('    + __{0}__: {1}'.format(name, value))
+    cache['formatters'] = [md_list_formatter(c) for c in columns]
+
+
+def md_list_rows_handler(cache, rows):
+    formatters = cache['formatters']
+    cache['out'].text(''.join([
+        ('* **' + escape_md_text(row[0]) + '**\n' if len(row) > 0 else '') +
+        ''.join([f(v) for (f, v) in zip(formatters, row)])
+        for row in rows]))
 
 
 md_list_handlers = {
         'info_handler': md_info_handler,
         'query_handler': md_query_handler,
         'columns_handler': md_list_columns_handler,
-        'row_handler': md_list_row_handler,
+        'rows_handler': md_list_rows_handler,
         'finalizer': md_finalizer
     }
 
-if cl_args.format == 'csv':
-    handlers = csv_handlers
-elif cl_args.format == 'tsv':
-    handlers = tsv_handlers
-elif cl_args.format == 'md_table':
-    handlers = md_table_handlers
-elif cl_args.format == 'html':
-    handlers = html_handlers
-elif cl_args.format == 'md_list':
-    handlers = md_list_handlers
-else:
-    handlers = table_handlers
+
+int_types = ['int2', 'int4', 'int8', 'oid']
+float_types = ['float4', 'float8']
+timestamp_types = ['timestamp', 'timestamptz']
+json_types = ['json', 'jsonb']
+epoch = datetime.datetime(1970, 1, 1)
+epoch_date = datetime.date(1970, 1, 1)
+
+
+def epoch_microseconds(v):
+    if v.tzinfo is not None:
+        v = v.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    delta = v - epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000 + \
+        delta.microseconds
+
+
+def nullable(f, null):
+    return lambda v: null if v is None else f(v)
+
+
+def json_float(v):
+    # NaN and infinity are not valid JSON numbers
+    if math.isfinite(v):
+        return repr(v)
+    return '"' + str(v) + '"'
+
+
+def ndjson_encoder(type_name):
+    """Builds the function for the JSON value of a column."""
+    if type_name in int_types:
+        f = str
+    elif type_name in float_types:
+        f = json_float
+    elif type_name == 'numeric':
+        # the decimal digits are kept, instead of rounding to a float
+        f = lambda v: str(v) if v.is_finite() else '"' + str(v) + '"'
+    elif type_name == 'bool':
+        f = lambda v: 'true' if v else 'false'
+    elif type_name in timestamp_types or type_name in ['date', 'time']:
+        f = lambda v: '"' + v.isoformat() + '"'
+    elif type_name in json_types:
+        f = json.dumps
+    elif type_name == 'bytea':
+        f = lambda v: '"' + base64.b64encode(v).decode('ascii') + '"'
+    else:
+        f = lambda v: json.dumps(str(v))
+    return nullable(f, 'null')
+
+
+def ndjson_columns_handler(cache, columns):
+    columns = make_unique(columns)
+    cache['keys'] = [json.dumps(c.name) + ':' for c in columns]
+    cache['encoders'] = [ndjson_encoder(c.type) for c in columns]
+
+
+def ndjson_rows_handler(cache, rows):
+    keys = cache['keys']
+    encoders = cache['encoders']
+    cache['out'].text(''.join([
+        '{' + ','.join([k + f(v) for (k, f, v) in zip(keys, encoders, row)]) +
+        '}\n'
+        for row in rows]))
+
+
+def record_info_handler(out, info):
+    # the machine readable formats carry only the result
+    pass
+
+
+def record_query_handler(out, query):
+    pass
+
+
+def record_finalizer(cache):
+    pass
+
+
+ndjson_handlers = {
+        'info_handler': record_info_handler,
+        'query_handler': record_query_handler,
+        'columns_handler': ndjson_columns_handler,
+        'rows_handler': ndjson_rows_handler,
+        'finalizer': record_finalizer
+    }
+
+
+binary_magic = b'PGQREC1\0'
+int64_struct = struct.Struct('<Bq')
+int32_struct = struct.Struct('<Bi')
+float64_struct = struct.Struct('<Bd')
+length_struct = struct.Struct('<I')
+# the tags of the values in a binary record
+tag_null = 0
+tag_int = 1
+tag_float = 2
+tag_bool = 3
+tag_text = 4
+tag_bytes = 5
+tag_timestamp = 6
+tag_numeric = 7
+tag_date = 8
+tag_json = 9
+binary_null = bytes([tag_null])
+
+
+def binary_chunk(tag, data):
+    return bytes([tag]) + length_struct.pack(len(data)) + data
+
+
+def binary_encoder(type_name):
+    """Builds the function for the tagged binary value of a column."""
+    if type_name in int_types:
+        f = lambda v: int64_struct.pack(tag_int, v)
+    elif type_name in float_types:
+        f = lambda v: float64_struct.pack(tag_float, v)
+    elif type_name == 'bool':
+        f = lambda v: bytes([tag_bool, 1 if v else 0])
+    elif type_name == 'numeric':
+        f = lambda v: binary_chunk(tag_numeric, str(v).encode('ascii'))
+    elif type_name in timestamp_types:
+        f = lambda v: int64_struct.pack(tag_timestamp, epoch_microseconds(v))
+    elif type_name == 'date':
+        f = lambda v: int32_struct.pack(tag_date, (v - epoch_date).days)
+    elif type_name in json_types:
+        f = lambda v: binary_chunk(tag_json, json.dumps(v).encode('utf-8'))
+    elif type_name == 'bytea':
+        f = lambda v: binary_chunk(tag_bytes, v)
+    else:
+        f = lambda v: binary_chunk(tag_text, str(v).encode('utf-8'))
+    return nullable(f, binary_null)
+
+
+def binary_columns_handler(cache, columns):
+    columns = make_unique(columns)
+    header = json.dumps({'columns': [
+        {'name': c.name, 'type': c.type} for c in columns]}).encode('utf-8')
+    cache['encoders'] = [binary_encoder(c.type) for c in columns]
+    cache['out'].write(
+        binary_magic + length_struct.pack(len(header)) + header)
+
+
+def binary_rows_handler(cache, rows):
+    encoders = cache['encoders']
+    records = []
+    for row in rows:
+        record = b''.join([f(v) for (f, v) in zip(encoders, row)])
+        records.append(length_struct.pack(len(record)))
+        records.append(record)
+    cache['out'].write(b''.join(records))
+
+
+binary_handlers = {
+        'info_handler': record_info_handler,
+        'query_handler': record_query_handler,
+        'columns_handler': binary_columns_handler,
+        'rows_handler': binary_rows_handler,
+        'finalizer': record_finalizer
+    }
 
 
 def split_query_arguments(args):
@@ -510,10 +2162,450 @@ def split_query_arguments(args):
         res[k] = v
     return res
 
-run_query(cl_args.host, cl_args.dbname,
-          cl_args.user, password, cl_args.ssl,
-          handlers,
-          load_query(cl_args.file),
-          split_query_arguments(cl_args.query_arguments),
-          info=cl_args.print_connection,
-          mogrify=cl_args.print_query)
+
+def run_command(cl_args, password, query, out, err, pool=None):
+    """Runs pgquery with parsed command line arguments.
+
+    The result is written to out, an OutputWriter, the messages
+    and the profile are written to err. Returns the exit code.
+    """
+    if cl_args.format not in supported_formats:
+        print(
+            'You must use an output format from the following list: ' +
+            ', '.join(supported_formats), file=err)
+        return 1
+
+    if cl_args.format == 'csv':
+        handlers = csv_handlers
+    elif cl_args.format == 'tsv':
+        handlers = tsv_handlers
+    elif cl_args.format == 'md_table':
+        handlers = md_table_handlers
+    elif cl_args.format == 'html':
+        handlers = html_handlers
+    elif cl_args.format == 'md_list':
+        handlers = md_list_handlers
+    elif cl_args.format == 'ndjson':
+        handlers = ndjson_handlers
+    elif cl_args.format == 'binary':
+        handlers = binary_handlers
+    else:
+        handlers = table_handlers
+
+    if cl_args.inventory:
+        try:
+            targets = read_inventory(cl_args.inventory)
+        except ValueError as e:
+            print(e, file=err)
+            return 1
+    elif cl_args.host and cl_args.dbname:
+        targets = None
+    else:
+        print('You must either specify the host and the database name, ' +
+              'or an inventory file.', file=err)
+        return 1
+
+    sweep = None
+    if cl_args.sweep:
+        try:
+            sweep = read_sweep(cl_args.sweep)
+        except (ValueError, csv.Error) as e:
+            print('Invalid sweep file: {0}'.format(e), file=err)
+            return 1
+        query_arguments = split_query_arguments(cl_args.query_arguments)
+        names = set(re.findall(r'%\((\w+)\)s', query))
+        for (i, row) in enumerate(sweep):
+            missing = names - set(row.keys()) - set(query_arguments.keys())
+            if missing:
+                print('The query arguments {0} are missing '.format(
+                          ', '.join(sorted(missing))) +
+                      'in row {0} of the sweep file.'.format(i + 1),
+                      file=err)
+                return 1
+
+    export = None
+    if cl_args.export_dir:
+        if targets is not None or cl_args.compare:
+            print('An export needs a host and a database name, ' +
+                  'and cannot be combined with an inventory ' +
+                  'or a comparison.', file=err)
+            return 1
+        os.makedirs(cl_args.export_dir, exist_ok=True)
+        export = {
+            'dir': cl_args.export_dir,
+            'key': cl_args.export_key,
+            'large_objects': cl_args.large_objects,
+        }
+    elif cl_args.export_key or cl_args.large_objects:
+        print('The export key and the large objects need an export directory.',
+              file=err)
+        return 1
+
+    if cl_args.compare:
+        if targets is not None or sweep is not None:
+            print('A comparison needs a host and a database name, ' +
+                  'and cannot be combined with an inventory or a sweep.',
+                  file=err)
+            return 1
+        try:
+            differences = run_compare(
+                cl_args.host, cl_args.dbname,
+                cl_args.compare[0], cl_args.compare[1],
+                cl_args.user, password, cl_args.ssl,
+                handlers,
+                query,
+                split_query_arguments(cl_args.query_arguments),
+                batch_size=max(1, cl_args.batch_size),
+                type_cache=not cl_args.no_type_cache,
+                table_sample=max(1, cl_args.table_sample),
+                key=cl_args.key,
+                chunk_rows=max(1, cl_args.compare_chunk),
+                pool=pool,
+                err=err,
+                out=out)
+        finally:
+            out.flush()
+        return 1 if differences else 0
+
+    if targets is not None:
+        try:
+            failed = run_fan_out(
+                targets, cl_args.user, password, cl_args.ssl,
+                handlers,
+                query,
+                split_query_arguments(cl_args.query_arguments),
+                info=cl_args.print_connection,
+                mogrify=cl_args.print_query,
+                batch_size=max(1, cl_args.batch_size),
+                pipeline=max(0, cl_args.pipeline),
+                type_cache=not cl_args.no_type_cache,
+                table_sample=max(1, cl_args.table_sample),
+                sweep=sweep,
+                parallel=max(1, cl_args.parallel),
+                pool=pool,
+                err=err,
+                out=out)
+        finally:
+            out.flush()
+        return 1 if failed else 0
+
+    nargs = {}
+    if cl_args.cache_ttl > 0 and sweep is None and export is None and \
+            is_single_select(query):
+        run = run_cached_query
+        nargs['cache_ttl'] = cl_args.cache_ttl
+        nargs['cache_size'] = cl_args.cache_size * 1024 * 1024
+    else:
+        run = run_query
+    if cl_args.profile or cl_args.profile_json or cl_args.explain:
+        nargs['profile'] = {}
+        nargs['explain'] = cl_args.explain
+    start = time.time()
+    try:
+        run(cl_args.host, cl_args.dbname,
+            cl_args.user, password, cl_args.ssl,
+            handlers,
+            query,
+            split_query_arguments(cl_args.query_arguments),
+            info=cl_args.print_connection,
+            mogrify=cl_args.print_query,
+            batch_size=max(1, cl_args.batch_size),
+            pipeline=max(0, cl_args.pipeline),
+            type_cache=not cl_args.no_type_cache,
+            copy=not cl_args.no_copy,
+            table_sample=max(1, cl_args.table_sample),
+            sweep=sweep,
+            export=export,
+            pool=pool,
+            out=out,
+            **nargs)
+    finally:
+        out.flush()
+
+    if 'profile' in nargs:
+        profile = nargs['profile']
+        profile['total'] = time.time() - start
+        profile['bytes'] = out.bytes
+        write_profile(profile, err)
+        if cl_args.profile_json:
+            with open(cl_args.profile_json, 'w', encoding='utf-8') as fh:
+                json.dump(profile, fh, indent=2)
+    return 0
+
+
+class ConnectionPool(object):
+    """Keeps the idle connections of the session server,
+    per host, database, user, password and SSL mode.
+
+    Connections, which are idle longer than idle_timeout seconds,
+    are closed.
+    """
+
+    def __init__(this, idle_timeout):
+        this.idle_timeout = idle_timeout
+        this.lock = threading.Lock()
+        this.idle = {}
+
+    def acquire(this, **params):
+        """Returns an idle connection, which still works,
+        or a new connection."""
+        key = tuple(sorted(params.items()))
+        while True:
+            with this.lock:
+                connections = this.idle.get(key, [])
+                if not connections:
+                    break
+                (conn, since) = connections.pop()
+            if not conn.closed and this.alive(conn):
+                return conn
+        return psycopg2.connect(**params)
+
+    def alive(this, conn):
+        """Checks an idle connection, which the server or a proxy
+        may have closed, with a cheap query."""
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            conn.close()
+            return False
+
+    def release(this, conn, **params):
+        """Returns a connection to the pool, after its session state,
+        like settings, temporary tables and prepared statements,
+        is discarded. A connection, which cannot be reset, is closed."""
+        if conn.closed:
+            return
+        try:
+            conn.rollback()
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute('DISCARD ALL')
+            cur.close()
+            conn.autocommit = False
+        except psycopg2.Error:
+            conn.close()
+            return
+        key = tuple(sorted(params.items()))
+        with this.lock:
+            this.idle.setdefault(key, []).append((conn, time.time()))
+
+    def evict(this, max_idle=None):
+        """Closes the connections, which are idle for too long."""
+        if max_idle is None:
+            max_idle = this.idle_timeout
+        now = time.time()
+        expired = []
+        with this.lock:
+            for (key, connections) in this.idle.items():
+                expired.extend([conn for (conn, since) in connections
+                                if now - since >= max_idle])
+                connections[:] = [(conn, since)
+                                  for (conn, since) in connections
+                                  if now - since < max_idle]
+        for conn in expired:
+            conn.close()
+
+
+# the options with file names, which are relative to the client
+file_options = ['-f', '--file', '-i', '--inventory', '-sw', '--sweep',
+                '-prj', '--profile-json', '-ed', '--export-dir']
+
+
+def default_socket():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or type_cache_dir
+    return path.join(runtime_dir, 'pgquery.sock')
+
+
+def absolute_file_arguments(args, cwd):
+    res = []
+    expect_file = False
+    for arg in args:
+        if expect_file:
+            res.append(path.join(cwd, arg))
+            expect_file = False
+        elif arg in file_options:
+            res.append(arg)
+            expect_file = True
+        elif arg.startswith('--') and '=' in arg and \
+                arg.split('=', 1)[0] in file_options:
+            (option, value) = arg.split('=', 1)
+            res.append(option + '=' + path.join(cwd, value))
+        else:
+            res.append(arg)
+    return res
+
+
+def send_frame(sock, kind, payload):
+    """Sends a message of the session protocol:
+    one byte for the kind, four bytes for the length and the payload."""
+    sock.sendall(kind + struct.pack('>I', len(payload)) + payload)
+
+
+def receive_frame(sock):
+    header = receive_bytes(sock, 5)
+    if header is None:
+        return (None, None)
+    (length,) = struct.unpack('>I', header[1:])
+    return (header[:1], receive_bytes(sock, length))
+
+
+def receive_bytes(sock, n):
+    chunks = []
+    while n > 0:
+        chunk = sock.recv(min(n, 1024 * 1024))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+class FrameWriter(object):
+    """A file-like object, which sends everything written to it
+    as frames of one kind to the client."""
+
+    def __init__(this, sock, kind):
+        this.sock = sock
+        this.kind = kind
+        this.lock = threading.Lock()
+
+    def write(this, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if data:
+            with this.lock:
+                send_frame(this.sock, this.kind, bytes(data))
+
+    def flush(this):
+        pass
+
+
+def run_request(request, out_fh, err, pool):
+    """Runs pgquery for a request of a client of the session server.
+
+    The request holds the command line arguments, the working directory
+    of the client and the query from its standard input.
+    """
+    args = request['args']
+    if '-h' in args or '--help' in args:
+        out_fh.write(parser.format_help())
+        return 0
+    try:
+        cl_args = parser.parse_args(
+            absolute_file_arguments(args, request['cwd']))
+    except SystemExit:
+        err.write(parser.format_usage() +
+                  'pgquery: invalid arguments, see pgquery -h\n')
+        return 2
+    try:
+        if cl_args.serve is not None:
+            print('A client cannot start a server.', file=err)
+            return 1
+        password = cl_args.password
+        if not password:
+            if cl_args.user == def_user:
+                password = def_password
+            else:
+                print('You must specify the password ' +
+                      'as a command line argument.', file=err)
+                return 1
+        query = load_query(cl_args.file) if cl_args.file \
+            else request['query'] or ''
+        return run_command(cl_args, password, query,
+                           OutputWriter(out_fh), err, pool=pool)
+    finally:
+        for f in [cl_args.file, cl_args.inventory, cl_args.sweep]:
+            if f:
+                f.close()
+
+
+def serve_client(sock, pool):
+    out_fh = FrameWriter(sock, b'O')
+    err = FrameWriter(sock, b'E')
+    try:
+        (kind, payload) = receive_frame(sock)
+        if kind != b'R':
+            return
+        try:
+            code = run_request(json.loads(payload.decode('utf-8')),
+                               out_fh, err, pool)
+        except Exception as e:
+            print(str(e).strip(), file=err)
+            code = 1
+        send_frame(sock, b'X', str(code).encode('ascii'))
+    except OSError:
+        # the client is gone
+        pass
+    finally:
+        sock.close()
+
+
+def serve(socket_path, idle_timeout):
+    """Runs the session server on a Unix socket,
+    which keeps the connections of the clients open for later requests.
+    """
+    pool = ConnectionPool(idle_timeout)
+
+    def evict_idle_connections():
+        while True:
+            time.sleep(min(idle_timeout, 10))
+            pool.evict()
+
+    threading.Thread(target=evict_idle_connections, daemon=True).start()
+
+    os.makedirs(path.dirname(socket_path), mode=0o700, exist_ok=True)
+    if path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # only the user may connect, because the connections are authenticated
+    umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+    print('Listening on {0}'.format(socket_path), file=stderr)
+    try:
+        while True:
+            (sock, address) = server.accept()
+            threading.Thread(target=serve_client, args=(sock, pool),
+                             daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(socket_path)
+        pool.evict(0)
+
+
+def main():
+    cl_args = parser.parse_args()
+    if cl_args.serve is not None:
+        serve(cl_args.serve or default_socket(),
+              max(1, cl_args.idle_timeout))
+        return
+    password = cl_args.password
+    if not password:
+        if cl_args.user == def_user:
+            password = def_password
+        else:
+            if cl_args.file:
+                password = getpass('Password: ')
+            else:
+                print('You must either specify the password ' +
+                      'as a command line argument, ' +
+                      'or a SQL file as input.')
+                exit(1)
+
+    code = run_command(cl_args, password, load_query(cl_args.file),
+                       OutputWriter(stdout.buffer), stderr)
+    if code:
+        exit(code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# Tobias Kiertscher <dev@mastersign.de>
+
+import os
+import argparse
+import time
+import datetime
+import contextlib
+import pgquery
+
+formats = {
+    'table': pgquery.table_handlers,
+    'csv': pgquery.csv_handlers,
+    'tsv': pgquery.tsv_handlers,
+    'html': pgquery.html_handlers,
+    'md_table': pgquery.md_table_handlers,
+    'md_list': pgquery.md_list_handlers,
+    'ndjson': pgquery.ndjson_handlers,
+    'binary': pgquery.binary_handlers,
+}
+
+parser = argparse.ArgumentParser(
+    description='measuring the output handlers of pgquery ' +
+                'with synthetic rows, without a database')
+parser.add_argument(
+    '-r', '--rows',
+    default=100000,
+    type=int,
+    help='The number of rows to format.')
+parser.add_argument(
+    '-c', '--columns',
+    default=20,
+    type=int,
+    help='The number of columns per row.')
+parser.add_argument(
+    '-bs', '--batch-size',
+    default=2000,
+    type=int,
+    help='The number of rows passed to the handlers at once.')
+parser.add_argument(
+    '-o', '--format',
+    nargs='*',
+    default=sorted(formats.keys()),
+    help='The output formats to measure: {0}.'.format(
+        ', '.join(sorted(formats.keys()))))
+
+column_types = [
+    ('int4', lambda i: i),
+    ('text', lambda i: 'value "{0}", more text'.format(i)),
+    ('float8', lambda i: i * 0.25),
+    ('bool', lambda i: i % 3 == 0),
+    ('timestamp', lambda i: datetime.datetime(2020, 1, 1, 12, i % 60)),
+    ('text', lambda i: None if i % 7 == 0 else 'name_{0}'.format(i)),
+]
+
+
+def synthetic_result(row_count, column_count):
+    types = [column_types[i % len(column_types)]
+             for i in range(column_count)]
+    columns = [pgquery.Column('col{0}'.format(i), t[0])
+               for (i, t) in enumerate(types)]
+    rows = [tuple([t[1](i) for t in types]) for i in range(row_count)]
+    return (columns, rows)
+
+
+def legacy_escape_csv_value(v, type_name):
+    v = str(v)
+    if '"' in v:
+        v = v.replace('"', '""')
+    if '"' in v or ',' in v or \
+       type_name == 'text':
+
+        v = '"{0}"'.format(v)
+
+    return v
+
+
+def legacy_csv_row_handler(cache, row):
+    # the csv row handler of pgquery before the output writer,
+    # with one print per row and one closure per row
+    columns = cache['columns']
+
+    def format_value(v, i):
+        return legacy_escape_csv_value(v, columns[i].type)
+
+    formatted_row = map(format_value, row, range(len(row)))
+    print(', '.join(formatted_row))
+
+
+legacy_csv_handlers = {
+    'columns_handler': lambda cache, columns:
+        cache.update({'columns': columns}),
+    'row_handler': legacy_csv_row_handler,
+    'finalizer': lambda cache: None,
+}
+
+
+def measure(handlers, columns, rows, batch_size):
+    with open(os.devnull, 'wb') as fh, \
+            open(os.devnull, 'w') as text_fh, \
+            contextlib.redirect_stdout(text_fh):
+        out = pgquery.OutputWriter(fh)
+        start = time.time()
+        cache = {'out': out, 'table_sample': 1000}
+        handlers['columns_handler'](cache, columns)
+        rows_handler = pgquery.rows_handler_of(handlers)
+        for i in range(0, len(rows), batch_size):
+            rows_handler(cache, rows[i:i + batch_size])
+        handlers['finalizer'](cache)
+        out.flush()
+        return (time.time() - start, out.bytes)
+
+
+def main():
+    args = parser.parse_args()
+    (columns, rows) = synthetic_result(args.rows, args.columns)
+    batch_size = max(1, args.batch_size)
+    print('{0} rows with {1} columns'.format(len(rows), len(columns)))
+    candidates = [(f, formats[f]) for f in args.format]
+    if 'csv' in args.format:
+        candidates.append(('csv (print per row)', legacy_csv_handlers))
+    for (name, handlers) in candidates:
+        (duration, size) = measure(handlers, columns, rows, batch_size)
+        print('{0:20} {1:8.3f} s {2:10.0f} rows/s {3:8.2f} us/row'.format(
+            name, duration, len(rows) / duration,
+            duration * 1e6 / len(rows)) +
+            ('' if not size else ' {0:8.1f} MB'.format(size / 1e6)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Tobias Kiertscher <dev@mastersign.de>
+
+# A thin client for the session server of pgquery (pgquery --serve).
+# It takes the same arguments as pgquery, sends them to the server
+# and writes the result, without connecting to PostgreSQL itself.
+
+import sys
+import os
+from os import path
+import socket
+import struct
+import json
+
+
+def default_socket():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or path.join(
+        os.environ.get('XDG_CACHE_HOME') or
+        path.join(path.expanduser('~'), '.cache'),
+        'pgquery')
+    return path.join(runtime_dir, 'pgquery.sock')
+
+
+def send_frame(sock, kind, payload):
+    sock.sendall(kind + struct.pack('>I', len(payload)) + payload)
+
+
+def receive_bytes(sock, n):
+    chunks = []
+    while n > 0:
+        chunk = sock.recv(min(n, 1024 * 1024))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+def reads_query_file(args):
+    return any([a in ['-f', '--file'] or a.startswith('--file=')
+                for a in args])
+
+
+def main():
+    args = sys.argv[1:]
+    socket_path = os.environ.get('PGQUERY_SOCKET') or default_socket()
+
+    # the query is read from stdin, like pgquery does without a file
+    query = None
+    if not reads_query_file(args) and \
+            '-h' not in args and '--help' not in args and \
+            not sys.stdin.isatty():
+        query = sys.stdin.read()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        print('No pgquery session server is listening on {0}. '.format(
+                  socket_path) +
+              'Start it with: pgquery --serve', file=sys.stderr)
+        exit(1)
+
+    request = {'args': args, 'cwd': os.getcwd(), 'query': query}
+    send_frame(sock, b'R', json.dumps(request).encode('utf-8'))
+
+    while True:
+        header = receive_bytes(sock, 5)
+        payload = None
+        if header is not None:
+            (length,) = struct.unpack('>I', header[1:])
+            payload = receive_bytes(sock, length)
+        if payload is None:
+            print('The pgquery session server closed the connection.',
+                  file=sys.stderr)
+            exit(1)
+        kind = header[:1]
+        if kind == b'O':
+            sys.stdout.buffer.write(payload)
+        elif kind == b'E':
+            sys.stdout.buffer.flush()
+            sys.stderr.buffer.write(payload)
+            sys.stderr.buffer.flush()
+        elif kind == b'X':
+            sys.stdout.buffer.flush()
+            sock.close()
+            exit(int(payload))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@
 # Tobias Kiertscher <dev@mastersign.de>
 
 from argparse import ArgumentParser
+import sys
 import time
 from datetime import datetime
 import pika
@@ -32,6 +33,18 @@ parser.add_argument(
     '-pw', '--password',
     default='devops',
     help='A password for authentification.')
+parser.add_argument(
+    '-pf', '--prefetch',
+    default=1000, type=int,
+    help='The number of unacknowledged messages the RabbitMQ node sends ahead. 0 means no limit. Default value is 1000.')
+parser.add_argument(
+    '-ab', '--ack-batch',
+    default=500, type=int,
+    help='The number of messages which are acknowledged at once. Default value is 500.')
+parser.add_argument(
+    '-ai', '--ack-interval',
+    default=1000, type=int,
+    help='The maximum number of milliseconds before consumed messages are acknowledged. Default value is 1000.')
 
 args = parser.parse_args()
 
@@ -57,6 +70,14 @@ result = channel.queue_declare(
     passive=True)
 queue_name = args.queue
 
+# Limit the unacknowledged messages
+
+ack_batch = max(1, args.ack_batch)
+if args.prefetch > 0:
+    channel.basic_qos(prefetch_count=args.prefetch)
+    # a batch larger than the prefetch count would wait for the interval
+    ack_batch = min(ack_batch, args.prefetch)
+
 
 # exract and format timestamp as string
 def get_timestamp(properties):
@@ -72,20 +93,60 @@ def get_timestamp(properties):
     return ts_str
 
 
+# the output and the delivery tag of the messages,
+# which are not acknowledged yet
+pending = {'lines': [], 'count': 0, 'delivery_tag': None, 'timeout': None}
+
+
 # process consumed message
 def message_callback(ch, method, properties, body):
     ts_str = get_timestamp(properties)
-    print('{} [{}]: {}'.format(ts_str, method.routing_key, body))
+    pending['lines'].append(
+        '{} [{}]: {}\n'.format(ts_str, method.routing_key, body))
+
+
+# write the buffered output and acknowledge all messages up to the last one,
+# a message is only acknowledged after its output is written
+def ack_pending(ch):
+    if pending['lines']:
+        sys.stdout.write(''.join(pending['lines']))
+        pending['lines'] = []
+    sys.stdout.flush()
+    if pending['timeout'] is not None:
+        connection.remove_timeout(pending['timeout'])
+        pending['timeout'] = None
+    if pending['delivery_tag'] is not None:
+        ch.basic_ack(delivery_tag=pending['delivery_tag'], multiple=True)
+        pending['delivery_tag'] = None
+        pending['count'] = 0
+
+
+def ack_timeout():
+    pending['timeout'] = None
+    ack_pending(channel)
 
 
 # wrap the message processing with exception handling and acknowleding
 def ack_callback(ch, method, properties, body):
     try:
         message_callback(ch, method, properties, body)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-    except (Exception) as e:
-        print("Error while acknowledging message:")
-        print(traceback.format_exc(e))
+    except (Exception):
+        # acknowledging the following messages with multiple=True
+        # would include the failed message, so it is rejected right away,
+        # it is requeued only once, to not redeliver it over and over
+        ack_pending(ch)
+        print("Error while processing message:")
+        print(traceback.format_exc())
+        ch.basic_nack(delivery_tag=method.delivery_tag,
+                      requeue=not method.redelivered)
+        return
+    pending['delivery_tag'] = method.delivery_tag
+    pending['count'] += 1
+    if pending['count'] >= ack_batch:
+        ack_pending(ch)
+    elif pending['timeout'] is None:
+        pending['timeout'] = connection.add_timeout(
+            args.ack_interval / 1000.0, ack_timeout)
 
 
 # start consuming messages
@@ -98,4 +159,8 @@ time.sleep(2.0)
 try:
     channel.start_consuming()
 except (KeyboardInterrupt):
+    # the messages with written output are acknowledged,
+    # the others are requeued, when the connection is closed
+    ack_pending(channel)
+    connection.close()
     exit()